@@ -1,18 +1,34 @@
-import streamlit as st
+import os
+import time
+
 import pandas as pd
-import numpy as np
+import streamlit as st
 
 import fetch_data as fd
+import instrumentation
 import plots
+from decomposition import TOTAL_SERIES, split_series_id
 
 
+DATASET = fd.PESTICIDES_DATASET
 DT_KEY = "dt"
-VALUE_KEY = "net_weight_kg"
+VALUE_KEY = "net_weight_kg"  # default metric
 PRODUCT_CLASS_KEY = "class"
 COUNTRY_CODE_KEY = "export_country_code"
 
 ROLLING_AVG_WINDOW_IN_MONTHS = 12
 
+# metric -> (label, unit)
+METRIC_LABELS = {
+    "net_weight_kg": ("Net Weight (kg)", "kg"),
+    "value_fob_usd": ("FOB Value (USD)", "USD"),
+    "value_frete_usd": ("Freight (USD)", "USD"),
+    "value_insurance_usd": ("Insurance (USD)", "USD"),
+    "value_cif_usd": ("CIF Value (USD)", "USD"),
+    "statistical_quantity": ("Statistical Quantity", "units"),
+}
+SEASONAL_Y_RANGE = {"net_weight_kg": [-2e7, 2e7]}  # other metrics autoscale
+
 LABEL_TO_COLOR_MAP = {
     "is_herbicide": "lightgreen",
     "is_fungicide": "rebeccapurple",
@@ -20,6 +36,51 @@ LABEL_TO_COLOR_MAP = {
     "is_domissanitario": "teal",
 }
 
+
+# ?diagnostics shows the stages of the rerun, ?profile also profiles it
+DIAGNOSTICS_ENABLED = os.environ.get("COMEXSTAT_DIAGNOSTICS") == "1"
+DIAGNOSTICS_COLUMNS = [
+    "stage",
+    "parent",
+    "seconds",
+    "rows",
+    "bytes",
+    "rss_delta_mb",
+    "process_peak_rss_mb",
+]
+
+
+def format_series(series: str) -> str:
+    group, name = split_series_id(series)
+    if group is None:
+        return "Total"
+    return f"{group.capitalize()}: {name}"
+
+
+# stage timings of this rerun, logged and shown in the diagnostics panel
+instrumentation.configure_logging()
+rerun_started_at = time.perf_counter()
+rerun_stages = instrumentation.start_collecting()
+show_diagnostics = DIAGNOSTICS_ENABLED or "diagnostics" in st.query_params
+profiler = instrumentation.Profiler() if "profile" in st.query_params else None
+if profiler is not None:
+    profiler.start()
+
+
+def show_diagnostics_panel():
+    report = profiler.stop() if profiler is not None else None
+    instrumentation.stop_collecting(rerun_stages)
+    if not (show_diagnostics or report):
+        return
+    with st.expander(
+        f"Diagnostics: rerun took {time.perf_counter() - rerun_started_at:.3f}s"
+    ):
+        stages = pd.DataFrame(rerun_stages).reindex(columns=DIAGNOSTICS_COLUMNS)
+        st.dataframe(stages, hide_index=True)
+        if report:
+            st.code(report)
+
+
 # Title and description
 st.title("Brazil's Pesticide Importation")
 st.write(
@@ -37,28 +98,53 @@ st.write(
 #
 
 
-@st.cache_data
-def load_raw_data():
-    return fd.create_denfensivos_agricolas_df()
+# The data is read from the current snapshot, built out of band by
+# refresh_worker.py. Only its aggregates are loaded, records stay on disk and
+# are queried through the query backend (DuckDB when installed).
+# Loaded objects are shared, never copied, between reruns and sessions: they
+# must not be modified. Caches are keyed by the data version only, "_"
+# arguments are not hashed by streamlit.
 
 
-data = load_raw_data()
+@st.cache_resource(max_entries=2)
+def load_snapshot(snapshot_version: str):
+    snapshot_store = fd.dataset_snapshot_store(DATASET)
+    if snapshot_version is None:
+        # nothing published yet: build (and publish) in process, once.
+        # the local store only fetches missing or still revisable months
+        snapshot = fd.build_snapshot(store=fd.dataset_store(DATASET), spec=DATASET)
+        snapshot_version = fd.save_snapshot(snapshot, snapshot_store)
+    return (
+        fd.load_snapshot(
+            snapshot_store, snapshot_version, with_data=False, spec=DATASET
+        ),
+        fd.snapshot_query_backend(snapshot_store, snapshot_version),
+    )
 
 
-@st.cache_data
-def melt_data(df: pd.DataFrame):
-    return fd.melt_and_group_by_classes_and_dt(df)
+# reading the pointer on every rerun picks up newly published snapshots
+with instrumentation.stage("app.load_snapshot"):
+    snapshot, query_backend = load_snapshot(
+        fd.dataset_snapshot_store(DATASET).current_version()
+    )
+rollup_cube = snapshot.rollup_cube
+seasonal_decompositions = snapshot.seasonal_decompositions
+data_version = snapshot.version
 
 
-melted_grouped_data = melt_data(data)
+@st.cache_resource
+def load_figure_cache():
+    return plots.FigureCache()
 
 
-@st.cache_data
-def load_seasonal_decompose_data(df: pd.DataFrame):
-    return fd.seasonal_decompose_pesticide_import_data(df)
+# figures are keyed by (name, data version, date range, metric, ...)
+figure_cache = load_figure_cache()
 
 
-seasonal_data_object = load_seasonal_decompose_data(data)
+# a count is a scan of the dt column, kept per (data version, date range)
+@st.cache_data(max_entries=64)
+def count_filtered_rows(data_version: str, start_dt, end_dt) -> int:
+    return query_backend.count(start_dt, end_dt)
 
 
 #
@@ -69,8 +155,8 @@ seasonal_data_object = load_seasonal_decompose_data(data)
 
 st.sidebar.header("Filters")
 
-min_date = np.array(data[DT_KEY].dt.to_pydatetime()).min()
-max_date = np.array(data[DT_KEY].dt.to_pydatetime()).max()
+min_date = rollup_cube.months[0].to_pydatetime()
+max_date = rollup_cube.months[-1].to_pydatetime()
 
 selected_dates = st.sidebar.slider(
     "Select Date Range:",
@@ -81,20 +167,36 @@ selected_dates = st.sidebar.slider(
 )
 start_dt, end_dt = selected_dates[0], selected_dates[1]
 
+# every metric is already aggregated, switching does not re-fetch or re-group
+value_key = st.sidebar.selectbox(
+    "Select Metric:",
+    options=list(METRIC_LABELS),
+    format_func=lambda key: METRIC_LABELS[key][0],
+)
+value_label, value_unit = METRIC_LABELS[value_key]
+
 # Apply filters
-filtered_data = data[(data[DT_KEY] >= start_dt) & (data[DT_KEY] <= end_dt)]
-filtered_melted_grouped_data = melted_grouped_data[
-    (melted_grouped_data[DT_KEY] >= start_dt) & (melted_grouped_data[DT_KEY] <= end_dt)
-]
-filtered_seasonal = seasonal_data_object.seasonal.loc[start_dt:end_dt]
-filtered_residual = seasonal_data_object.resid.loc[start_dt:end_dt]
-filtered_trend = seasonal_data_object.trend.loc[start_dt:end_dt]
+with instrumentation.stage("app.filter", backend=query_backend.name) as record:
+    filtered_row_count = count_filtered_rows(data_version, start_dt, end_dt)
+    sum_by_class = rollup_cube.range_sum(PRODUCT_CLASS_KEY, start_dt, end_dt, value_key)
+    record["rows"] = filtered_row_count
+figure_key = (data_version, start_dt, end_dt, value_key)
 
-if filtered_data.empty:
+if filtered_row_count == 0:
     st.warning("No data found for selected filters!")
+    show_diagnostics_panel()
     st.stop()
 
 
+def show_figure(name: str, key: tuple, build):
+    # the build is timed on cache misses only, the serialization every rerun
+    figure = figure_cache.get_or_build(
+        (name,) + key, instrumentation.instrumented(f"app.build.{name}")(build)
+    )
+    with instrumentation.stage(f"app.render.{name}"):
+        st.plotly_chart(figure)
+
+
 #
 ##
 ### Main visualization
@@ -103,29 +205,50 @@ if filtered_data.empty:
 
 ### Sidebar
 st.sidebar.header("Total Import:")
-total_weight_in_kg = filtered_melted_grouped_data[VALUE_KEY].sum()
-weight_in_units_of_blue_whales = int(total_weight_in_kg / 1e3 / 150 / 1e3) * int(1e3)  # TODO why i did this?
-weight_in_units_of_loaded_747_planes = int(total_weight_in_kg / 1e3 / 400 / 1e3) * int(1e3)
+total_value = sum_by_class.sum()
 
-if total_weight_in_kg > 1e9:
-    display = (total_weight_in_kg / 1e9).round(1)
-    st.sidebar.metric(label="Weight", value=f"{display} Billion kg")
+if total_value > 1e9:
+    display = (total_value / 1e9).round(1)
+    st.sidebar.metric(label=value_label, value=f"{display} Billion {value_unit}")
 else:
-    display = (total_weight_in_kg / 1e6).round(1)
-    st.sidebar.metric(label="Weight", value=f"{display} Million kg")
-st.sidebar.text(f"That's equivalent to {weight_in_units_of_blue_whales} blue whales, or {weight_in_units_of_loaded_747_planes} loaded Boeing 747s")
+    display = (total_value / 1e6).round(1)
+    st.sidebar.metric(label=value_label, value=f"{display} Million {value_unit}")
+
+if value_key == VALUE_KEY:
+    weight_in_units_of_blue_whales = int(total_value / 1e3 / 150 / 1e3) * int(1e3)  # TODO why i did this?
+    weight_in_units_of_loaded_747_planes = int(total_value / 1e3 / 400 / 1e3) * int(1e3)
+    st.sidebar.text(f"That's equivalent to {weight_in_units_of_blue_whales} blue whales, or {weight_in_units_of_loaded_747_planes} loaded Boeing 747s")
 
 ## trend plot
+def build_trend_figure():
+    # bars of every class plus the trend line, aggregated to fit the budget
+    frequency = plots.choose_frequency(
+        start_dt, end_dt, n_series=len(LABEL_TO_COLOR_MAP) + 1
+    )
+    monthly_by_class_df = rollup_cube.monthly(
+        PRODUCT_CLASS_KEY, start_dt, end_dt, value_key
+    )
+    filtered_trend = seasonal_decompositions.get(value_key).trend.loc[start_dt:end_dt]
+    return plots.plot_trend_with_bar(
+        data=plots.downsample(
+            monthly_by_class_df,
+            DT_KEY,
+            value_key,
+            frequency,
+            group_key=PRODUCT_CLASS_KEY,
+        ),
+        x_key=DT_KEY,
+        y_key=value_key,
+        trend_arr=plots.downsample_series(filtered_trend, frequency),
+        color_key=PRODUCT_CLASS_KEY,
+        color_map=LABEL_TO_COLOR_MAP,
+        x_title=f"Date ({plots.FREQUENCY_LABELS[frequency]})",
+        y_title=value_label,
+    )
+
+
 st.subheader("Import Trends by Year")
-fig_trend = plots.plot_trend_with_bar(
-    data=filtered_melted_grouped_data,
-    x_key=DT_KEY,
-    y_key=VALUE_KEY,
-    trend_arr=filtered_trend,
-    color_key=PRODUCT_CLASS_KEY,
-    color_map=LABEL_TO_COLOR_MAP,
-)
-st.plotly_chart(fig_trend)
+show_figure("trend", figure_key, build_trend_figure)
 
 st.write(
     """
@@ -135,55 +258,103 @@ st.write(
 
 ## seasonal plot
 st.subheader("Sazonality effect on imports")
-fig_seasonal = plots.plot_seasonal_decompose(
-    filtered_seasonal, 
-    filtered_residual
+seasonal_series = st.selectbox(
+    "Select Series:",
+    options=seasonal_decompositions.series_names(value_key),
+    format_func=format_series,
 )
-st.plotly_chart(fig_seasonal)
+
+
+def build_seasonal_figure():
+    frequency = plots.choose_frequency(start_dt, end_dt, n_series=2)
+    seasonal_data_object = seasonal_decompositions.get(value_key, seasonal_series)
+    return plots.plot_seasonal_decompose(
+        plots.downsample_series(
+            seasonal_data_object.seasonal.loc[start_dt:end_dt], frequency, how="mean"
+        ),
+        plots.downsample_series(
+            seasonal_data_object.resid.loc[start_dt:end_dt], frequency, how="mean"
+        ),
+        y_title=value_label,
+        # fixed range only makes sense for the total
+        y_range=(
+            SEASONAL_Y_RANGE.get(value_key) if seasonal_series == TOTAL_SERIES else None
+        ),
+    )
+
+
+show_figure("seasonal", figure_key + (seasonal_series,), build_seasonal_figure)
+
 
 ## geographical plot
+def build_geo_figure():
+    sum_by_country = rollup_cube.range_sum(
+        COUNTRY_CODE_KEY, start_dt, end_dt, value_key
+    )
+    sum_by_country_df = (
+        sum_by_country.drop(index="BRA", errors="ignore")
+        .rename_axis(COUNTRY_CODE_KEY)
+        .rename(value_key)
+        .reset_index()
+    )
+    sum_by_country_df = sum_by_country_df[sum_by_country_df[value_key] != 0]
+
+    return plots.plot_choropleth(
+        data=sum_by_country_df,
+        country_code_key=COUNTRY_CODE_KEY,
+        value_key=value_key,
+    )
+
+
 st.subheader("Exports by Country")
-_filter_br_cond = filtered_data[COUNTRY_CODE_KEY] != "BRA"
-sum_by_country_df = (
-    filtered_data[_filter_br_cond]
-    .groupby(COUNTRY_CODE_KEY)[VALUE_KEY]
-    .sum()
-    .reset_index()
-)
+show_figure("geo", figure_key, build_geo_figure)
 
-fig_geo = plots.plot_choropleth(
-    data=sum_by_country_df,
-    country_code_key=COUNTRY_CODE_KEY,
-    value_key=VALUE_KEY,
-)
-st.plotly_chart(fig_geo)
 
 ## product classes plot
-sum_by_class_df = (
-    filtered_melted_grouped_data.groupby(PRODUCT_CLASS_KEY)[VALUE_KEY]
-    .sum()
-    .reset_index()
-)
-st.subheader("Share of Imported Product Classes")
-fig_products = plots.plot_bar_by_class(
-    sum_by_class_df,
-    x_key=PRODUCT_CLASS_KEY,
-    y_key=VALUE_KEY,
-    color_key=PRODUCT_CLASS_KEY,
-    color_map=LABEL_TO_COLOR_MAP,
-    title=None,
-)
-st.plotly_chart(fig_products)
+def build_products_figure():
+    sum_by_class_df = (
+        sum_by_class.rename_axis(PRODUCT_CLASS_KEY).rename(value_key).reset_index()
+    )
+    return plots.plot_bar_by_class(
+        sum_by_class_df,
+        x_key=PRODUCT_CLASS_KEY,
+        y_key=value_key,
+        color_key=PRODUCT_CLASS_KEY,
+        color_map=LABEL_TO_COLOR_MAP,
+        title=None,
+    )
 
 
-# display raw data
-st.subheader("Raw Data")
-st.dataframe(filtered_data)
+st.subheader("Share of Imported Product Classes")
+show_figure("products", figure_key, build_products_figure)
 
 
-# download raw data
-st.download_button(
-    "Download Filtered Data",
-    filtered_data.to_csv(index=False),
-    file_name="filtered_data.csv",
+# display raw data, one page at a time so the payload does not grow with the range
+st.subheader("Raw Data")
+page_count = plots.page_count(filtered_row_count)
+page = st.number_input(
+    f"Page (of {page_count}):", min_value=1, max_value=page_count, value=1
 )
+with instrumentation.stage("app.raw_page") as record:
+    raw_page = query_backend.rows(
+        start_dt,
+        end_dt,
+        limit=plots.RAW_TABLE_PAGE_SIZE,
+        offset=(page - 1) * plots.RAW_TABLE_PAGE_SIZE,
+    )
+    st.dataframe(raw_page)
+    record["rows"] = len(raw_page)
+
+
+# download raw data: the whole range is only read and serialized on request
+if st.button("Prepare Download"):
+    with instrumentation.stage("app.csv") as record:
+        filtered_csv = query_backend.rows(start_dt, end_dt).to_csv(index=False)
+        record["bytes"] = len(filtered_csv)
+    st.download_button(
+        "Download Filtered Data",
+        filtered_csv,
+        file_name="filtered_data.csv",
+    )
+
+show_diagnostics_panel()
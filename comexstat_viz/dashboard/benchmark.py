@@ -0,0 +1,214 @@
+"""
+End-to-end load benchmark against the offline mock COMEXSTAT server.
+
+Times (and, unless --no-memory, traces the peak memory of) every stage of
+the load at several multiples of the current row count:
+
+    python benchmark.py --scales 1 10 100 --output bench.json
+    python benchmark.py --scales 1 10 --baseline bench.json  # exits 1 on regressions
+    python benchmark.py --scales 10 --workers 1 2 4 8  # process pool scaling
+"""
+
+import argparse
+import json
+import tempfile
+import time
+import tracemalloc
+import warnings
+
+import fetch_data as fd
+import plots
+from comexstat_client import FilterCache
+from mock_comexstat import start_mock_server
+
+DEFAULT_SCALES = [1, 10, 100]
+# a stage regresses when slower than baseline * (1 + tolerance)
+DEFAULT_TOLERANCE = 0.25
+
+
+def measure(function, *args, trace_memory=True, **kwargs) -> tuple:
+    """
+    Run a stage, returning (result, seconds, peak MB). The peak memory is
+    taken from a second, traced, run so tracing does not skew the timing.
+    """
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    seconds = time.perf_counter() - start
+
+    peak_mb = None
+    if trace_memory:
+        tracemalloc.start()
+        function(*args, **kwargs)
+        peak_mb = tracemalloc.get_traced_memory()[1] / 1e6
+        tracemalloc.stop()
+
+    return result, seconds, peak_mb
+
+
+def build_frame(table):
+    return fd.apply_compact_schema(
+        table.to_pandas().rename(columns=fd.COLUMN_RENAME_MAP)
+    )
+
+
+def build_plots(melted, seasonal, df, value_key=fd.ANALYSIS_VALUE_KEYS[0]):
+    sum_by_country = (
+        df.groupby("export_country_code", observed=True)[value_key].sum().reset_index()
+    )
+    sum_by_class = melted.groupby("class")[value_key].sum().reset_index()
+    return [
+        plots.plot_trend_with_bar(
+            data=melted,
+            x_key=fd.ANALYSIS_DT_KEY,
+            y_key=value_key,
+            trend_arr=seasonal.trend[value_key],
+            color_key="class",
+            color_map={},
+        ),
+        plots.plot_seasonal_decompose(
+            seasonal.seasonal[value_key], seasonal.resid[value_key]
+        ),
+        plots.plot_choropleth(sum_by_country, "export_country_code", value_key),
+        plots.plot_bar_by_class(
+            sum_by_class, "class", value_key, "class", {}, title=None
+        ),
+    ]
+
+
+def run_scale(
+    mock, base_url: str, scale: float, trace_memory: bool, workers: list = ()
+) -> dict:
+    mock.scale = scale
+    stages = {}
+
+    def stage(name, function, *args, **kwargs):
+        result, seconds, peak_mb = measure(
+            function, *args, trace_memory=trace_memory, **kwargs
+        )
+        stages[name] = {"seconds": seconds, "peak_mb": peak_mb}
+        return result
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        catalog = fd.get_comexstat_filter_possible_values(
+            "ncm", base_url=base_url, filter_cache=FilterCache(cache_dir)
+        )
+    ncm_ids = list(fd.create_id_to_classification_map(catalog))
+
+    table = stage(
+        "fetch",
+        fd.query_defensivos_agricolas_partitioned,
+        ncm_produt_ids=ncm_ids,
+        metrics_columns=fd.POSSIBLE_METRICS,
+        start_year=fd.START_YEAR,
+        end_year=fd.END_YEAR,
+        base_url=base_url,
+    )
+    df = stage("build_frame", build_frame, table)
+    stage("check_data_quality", fd.check_data_quality, df)
+    for max_workers in workers:
+        # the pool is forced, whatever the number of rows
+        stage(
+            f"process_classify_{max_workers}w",
+            fd.process_and_classify,
+            df,
+            max_workers=max_workers,
+            min_pool_rows=0,
+        )
+    df = stage("process", fd.process_defensivos_agricolas_df, df)
+    df = stage("classify", fd.create_one_hot_classification, df)
+    melted = stage("melt", fd.melt_and_group_by_classes_and_dt, df)
+    rollup_cube = stage("rollup_cube", fd.create_rollup_cube, df)
+    seasonal = stage(
+        "seasonal_decompose", fd.seasonal_decompose_pesticide_import_data, df
+    )
+    stage("seasonal_decompositions", fd.create_seasonal_decompositions, rollup_cube)
+    stage("plots", build_plots, melted, seasonal, df)
+
+    return {"rows": len(df), "stages": stages}
+
+
+def find_regressions(results: dict, baseline: dict, tolerance: float) -> list:
+    regressions = []
+    for scale, result in results.items():
+        baseline_stages = baseline.get(scale, {}).get("stages", {})
+        for name, measured in result["stages"].items():
+            if name not in baseline_stages:
+                continue
+            for metric in ("seconds", "peak_mb"):
+                reference = baseline_stages[name][metric]
+                value = measured[metric]
+                if reference and value and value > reference * (1 + tolerance):
+                    regressions.append(
+                        f"{scale}x {name} {metric}: {value:.3f} > {reference:.3f}"
+                    )
+    return regressions
+
+
+def print_results(results: dict):
+    print(f"{'scale':>6} {'rows':>10} {'stage':<24} {'seconds':>9} {'peak MB':>9}")
+    for scale, result in results.items():
+        for name, measured in result["stages"].items():
+            peak = (
+                f"{measured['peak_mb']:.1f}" if measured["peak_mb"] is not None else "-"
+            )
+            print(
+                f"{scale + 'x':>6} {result['rows']:>10} {name:<24} "
+                f"{measured['seconds']:>9.3f} {peak:>9}"
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--scales", type=float, nargs="+", default=DEFAULT_SCALES)
+    parser.add_argument(
+        "--latency", type=float, default=0, help="mock seconds per request"
+    )
+    parser.add_argument("--no-memory", action="store_true", help="skip memory tracing")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        nargs="*",
+        default=[],
+        help="also time process_and_classify with these process pool sizes",
+    )
+    parser.add_argument("--output", help="write the results as json")
+    parser.add_argument("--baseline", help="json results to compare against")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    args = parser.parse_args()
+
+    server, mock, base_url = start_mock_server(latency=args.latency)
+    # the mock data changes with the scale, under the same queries: never
+    # reuse a table of a previous run
+    fd.query_flights().ttl = 0
+    warnings.simplefilter("ignore")  # unverified https / quality warnings
+
+    results = {}
+    try:
+        for scale in args.scales:
+            results[f"{scale:g}"] = run_scale(
+                mock,
+                base_url,
+                scale,
+                trace_memory=not args.no_memory,
+                workers=args.workers,
+            )
+    finally:
+        server.shutdown()
+
+    print_results(results)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=1)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = find_regressions(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
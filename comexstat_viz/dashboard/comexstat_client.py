@@ -0,0 +1,196 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+import requests
+
+from collections import OrderedDict
+from concurrent.futures import Future
+from datetime import datetime, timedelta
+from pathlib import Path
+from requests.adapters import HTTPAdapter
+
+# (connect, read) timeouts in seconds
+REQUEST_TIMEOUT = (10, 120)
+
+# keep-alive pool, sized for the partitioned fetch thread pool
+POOL_CONNECTIONS = 4
+POOL_MAXSIZE = 16
+
+FILTER_CACHE_DIR = Path(__file__).resolve().parents[1] / "data" / "cache" / "filters"
+FILTER_CACHE_TTL = timedelta(days=7)  # the NCM catalog changes rarely
+
+# results of identical queries are shared for a few minutes, within a memory
+# budget: a few partition tables, not whole histories
+RESULT_TTL_SECONDS = 300
+RESULT_CACHE_MAX_BYTES = 32_000_000
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session() -> requests.Session:
+    """
+    Shared keep-alive session, created on first use.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE
+            )
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            session.verify = (
+                False  ## investigate SSL for this api. No documentation explaining
+            )
+            _session = session
+        return _session
+
+
+def get(url: str, timeout=REQUEST_TIMEOUT, **kwargs) -> requests.Response:
+    return get_session().get(url, timeout=timeout, **kwargs)
+
+
+class FilterCache:
+    """
+    On-disk cache of `/filters/*` responses.
+
+    Entries younger than the TTL are served without any request. Expired
+    entries are revalidated with their ETag, so an unchanged catalog costs a
+    304 instead of a full download.
+    """
+
+    def __init__(self, cache_dir=FILTER_CACHE_DIR, ttl: timedelta = FILTER_CACHE_TTL):
+        self.cache_dir = Path(cache_dir)
+        self.ttl = ttl
+
+    def _path(self, url: str, filter_name: str) -> Path:
+        url_hash = hashlib.sha1(url.encode()).hexdigest()[:8]
+        return self.cache_dir / f"{filter_name}-{url_hash}.json"
+
+    def _load(self, path: Path):
+        if not path.exists():
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def _save(self, path: Path, entry: dict):
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, path)
+
+    def get(self, url: str, filter_name: str, timeout=REQUEST_TIMEOUT):
+        """
+        Return the json payload of a filter endpoint, from cache when possible.
+        """
+        path = self._path(url, filter_name)
+        entry = self._load(path)
+        now = datetime.now()
+
+        if entry is not None:
+            fetched_at = datetime.fromisoformat(entry["fetched_at"])
+            if now - fetched_at < self.ttl:
+                return entry["payload"]
+
+        headers = {}
+        if entry is not None and entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+
+        response = get(url, timeout=timeout, headers=headers)
+        if response.status_code == 304 and entry is not None:
+            entry["fetched_at"] = now.isoformat()
+            self._save(path, entry)
+            return entry["payload"]
+
+        response.raise_for_status()
+        payload = response.json()
+        self._save(
+            path,
+            {
+                "fetched_at": now.isoformat(),
+                "etag": response.headers.get("ETag"),
+                "payload": payload,
+            },
+        )
+        return payload
+
+
+class SingleFlight:
+    """
+    One call per key at a time, across threads (and streamlit sessions):
+    callers of a key already in flight wait for it and share its result, or
+    its exception. Results must not be modified by the callers.
+
+    Results are then kept for `ttl` seconds, so a kept result can be served
+    up to `ttl` (5 minutes by default) after the API changed. The kept
+    results are bounded by their `nbytes` (e.g. Arrow tables), least recently
+    used first out; results without one, or larger than `max_bytes`, are
+    only shared with the callers waiting for them.
+    """
+
+    def __init__(
+        self, ttl: float = RESULT_TTL_SECONDS, max_bytes: int = RESULT_CACHE_MAX_BYTES
+    ):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._in_flight = {}  # key -> Future
+        self._results = OrderedDict()  # key -> (expires_at, result, nbytes)
+        self._kept_bytes = 0
+        self._lock = threading.Lock()
+
+    def do(self, key: str, function, *args, **kwargs):
+        with self._lock:
+            cached = self._results.get(key)
+            if cached is not None and cached[0] > time.monotonic():
+                self._results.move_to_end(key)
+                return cached[1]
+            self._discard(key)  # expired
+            future = self._in_flight.get(key)
+            is_leader = future is None
+            if is_leader:
+                future = self._in_flight[key] = Future()
+
+        if not is_leader:
+            return future.result()
+
+        try:
+            result = function(*args, **kwargs)
+        except BaseException as e:
+            with self._lock:
+                del self._in_flight[key]
+            future.set_exception(e)
+            raise
+
+        with self._lock:
+            del self._in_flight[key]
+            nbytes = getattr(result, "nbytes", None)
+            if self.ttl > 0 and nbytes is not None and nbytes <= self.max_bytes:
+                now = time.monotonic()
+                for expired_key in [
+                    cached_key
+                    for cached_key, (expires_at, _, _) in self._results.items()
+                    if expires_at <= now
+                ]:
+                    self._discard(expired_key)
+                self._discard(key)
+                self._results[key] = (now + self.ttl, result, nbytes)
+                self._kept_bytes += nbytes
+                while self._kept_bytes > self.max_bytes:
+                    self._discard(next(iter(self._results)))
+        future.set_result(result)
+        return result
+
+    def _discard(self, key: str):
+        if key in self._results:
+            self._kept_bytes -= self._results.pop(key)[2]
+
+    def clear(self):
+        with self._lock:
+            self._results.clear()
+            self._kept_bytes = 0
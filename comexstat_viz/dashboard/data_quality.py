@@ -0,0 +1,245 @@
+import numpy as np
+import pandas as pd
+
+from collections import defaultdict
+from dataclasses import dataclass, field
+
+VALID_CONSEQUENCE_LEVELS = {"warning", "error"}
+MAX_REPORTED_KEYS = 10
+
+
+@dataclass
+class DataQualityReport:
+    rows_checked: int = 0
+    nan_counts: dict = field(default_factory=dict)  # column -> NaN count
+    duplicate_count: int = 0
+    duplicate_keys: list = field(default_factory=list)  # first offending rows
+    sampled: bool = False
+    # when checked with an id column (e.g. the NCM id): the rows checked per
+    # id, and {"nan_counts", "duplicate_count", "duplicate_keys"} of the ids
+    # having issues, so the report can be narrowed to some ids (see select)
+    id_column: str = None
+    id_rows: dict = field(default_factory=dict)
+    id_issues: dict = field(default_factory=dict)
+
+    @property
+    def nan_count(self) -> int:
+        return sum(self.nan_counts.values())
+
+    @property
+    def has_issues(self) -> bool:
+        return self.nan_count > 0 or self.duplicate_count > 0
+
+    def merge(self, other: "DataQualityReport") -> "DataQualityReport":
+        id_rows = dict(self.id_rows)
+        for id_value, rows in other.id_rows.items():
+            id_rows[id_value] = id_rows.get(id_value, 0) + rows
+        id_issues = dict(self.id_issues)
+        for id_value, issues in other.id_issues.items():
+            id_issues[id_value] = (
+                _merge_issues(id_issues[id_value], issues)
+                if id_value in id_issues
+                else issues
+            )
+        return DataQualityReport(
+            rows_checked=self.rows_checked + other.rows_checked,
+            nan_counts=_add_counts(self.nan_counts, other.nan_counts),
+            duplicate_count=self.duplicate_count + other.duplicate_count,
+            duplicate_keys=(self.duplicate_keys + other.duplicate_keys)[
+                :MAX_REPORTED_KEYS
+            ],
+            sampled=self.sampled or other.sampled,
+            id_column=self.id_column or other.id_column,
+            id_rows=id_rows,
+            id_issues=id_issues,
+        )
+
+    def select(self, ids: list) -> "DataQualityReport":
+        """
+        Report of the rows of the given ids only, e.g. the NCM ids of a
+        dataset stored with other products. A report checked without an id
+        column cannot be narrowed and is returned as is.
+        """
+        if self.id_column is None:
+            return self
+        report = DataQualityReport(sampled=self.sampled, id_column=self.id_column)
+        for id_value in map(str, ids):
+            if id_value not in self.id_rows:
+                continue
+            issues = self.id_issues.get(id_value, {})
+            report = report.merge(
+                DataQualityReport(
+                    rows_checked=self.id_rows[id_value],
+                    nan_counts=issues.get("nan_counts", {}),
+                    duplicate_count=issues.get("duplicate_count", 0),
+                    duplicate_keys=issues.get("duplicate_keys", []),
+                    id_column=self.id_column,
+                    id_rows={id_value: self.id_rows[id_value]},
+                    id_issues={id_value: issues} if issues else {},
+                )
+            )
+        return report
+
+    def issues(self) -> list:
+        issues = []
+        if self.nan_count:
+            columns = {column: n for column, n in self.nan_counts.items() if n}
+            issues.append(
+                f"{self.nan_count} NaN values detected in the DataFrame {columns}."
+            )
+        if self.duplicate_count:
+            issues.append(
+                f"{self.duplicate_count} duplicate rows detected in the DataFrame, "
+                f"e.g. {self.duplicate_keys[:3]}."
+            )
+        if self.sampled:
+            issues.append(f"(checked a sample of {self.rows_checked} rows)")
+        return issues
+
+    def to_dict(self) -> dict:
+        return {
+            "rows_checked": self.rows_checked,
+            "nan_counts": self.nan_counts,
+            "duplicate_count": self.duplicate_count,
+            "duplicate_keys": self.duplicate_keys,
+            "sampled": self.sampled,
+            "id_column": self.id_column,
+            "id_rows": self.id_rows,
+            "id_issues": self.id_issues,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "DataQualityReport":
+        return cls(**data)
+
+
+def _add_counts(counts: dict, other: dict) -> dict:
+    added = dict(counts)
+    for key, count in other.items():
+        added[key] = added.get(key, 0) + count
+    return added
+
+
+def _merge_issues(issues: dict, other: dict) -> dict:
+    return {
+        "nan_counts": _add_counts(
+            issues.get("nan_counts", {}), other.get("nan_counts", {})
+        ),
+        "duplicate_count": issues.get("duplicate_count", 0)
+        + other.get("duplicate_count", 0),
+        "duplicate_keys": (
+            issues.get("duplicate_keys", []) + other.get("duplicate_keys", [])
+        )[:MAX_REPORTED_KEYS],
+    }
+
+
+def row_fingerprints(df: pd.DataFrame, key_columns: list = None) -> np.ndarray:
+    """
+    One vectorized 64 bit hash per row of the key columns (all by default).
+    Categorical columns only hash their categories.
+    """
+    keys = df if key_columns is None else df[key_columns]
+    return pd.util.hash_pandas_object(keys, index=False).to_numpy()
+
+
+class DataQualityChecker:
+    """
+    Incremental NaN / duplicate check. Feed it chunks (e.g. fetched
+    partitions) with update(); duplicates are detected across chunks by
+    keeping the fingerprints already seen.
+    """
+
+    def __init__(
+        self,
+        key_columns: list = None,
+        max_reported_keys: int = MAX_REPORTED_KEYS,
+        id_column: str = None,
+    ):
+        self.key_columns = key_columns
+        self.max_reported_keys = max_reported_keys
+        self.id_column = id_column  # issues are also reported per id
+        self._seen = np.empty(0, dtype=np.uint64)
+        self.report = DataQualityReport()
+
+    def update(self, df: pd.DataFrame) -> DataQualityReport:
+        """
+        Check a chunk, returning its own report. The cumulative report is
+        kept in `self.report`.
+        """
+        nan_counts = (len(df) - df.count()).to_dict()  # no NaN matrix
+
+        fingerprints = row_fingerprints(df, self.key_columns)
+        duplicated = pd.Series(fingerprints).duplicated().to_numpy()
+        if len(self._seen):
+            duplicated = duplicated | np.isin(fingerprints, self._seen)
+        self._seen = np.concatenate([self._seen, fingerprints])
+
+        keys = df if self.key_columns is None else df[self.key_columns]
+        chunk_report = DataQualityReport(
+            rows_checked=len(df),
+            nan_counts={column: int(n) for column, n in nan_counts.items()},
+            duplicate_count=int(duplicated.sum()),
+            duplicate_keys=self._offending_keys(keys[duplicated]),
+        )
+        if self.id_column is not None:
+            self._add_id_issues(chunk_report, df, keys, duplicated)
+        self.report = self.report.merge(chunk_report)
+        return chunk_report
+
+    def _offending_keys(self, keys: pd.DataFrame) -> list:
+        return [
+            {column: str(value) for column, value in row.items()}
+            for row in keys.head(self.max_reported_keys).to_dict("records")
+        ]
+
+    def _add_id_issues(
+        self,
+        report: DataQualityReport,
+        df: pd.DataFrame,
+        keys: pd.DataFrame,
+        duplicated: np.ndarray,
+    ):
+        """
+        Fill the per id rows and issues of a chunk report. Only the columns
+        with NaNs and the duplicated rows are grouped by id.
+        """
+        ids = df[self.id_column].astype(str)
+        id_issues = defaultdict(dict)
+        for column, n in report.nan_counts.items():
+            if n:
+                for id_value, count in df[column].isna().groupby(ids).sum().items():
+                    if count:
+                        id_issues[id_value].setdefault("nan_counts", {})[column] = int(
+                            count
+                        )
+        for id_value, id_keys in keys[duplicated].groupby(ids[duplicated]):
+            id_issues[id_value]["duplicate_count"] = len(id_keys)
+            id_issues[id_value]["duplicate_keys"] = self._offending_keys(id_keys)
+
+        report.id_column = self.id_column
+        report.id_rows = {
+            id_value: int(rows) for id_value, rows in ids.value_counts().items()
+        }
+        report.id_issues = dict(id_issues)
+
+
+def check_frame(
+    df: pd.DataFrame,
+    key_columns: list = None,
+    sample_size: int = None,
+    id_column: str = None,
+) -> DataQualityReport:
+    """
+    Check a whole frame. With a sample_size, only that many random rows are
+    checked, trading completeness for a fast interactive startup. With an
+    id_column, the report can be narrowed to some ids (see
+    DataQualityReport.select).
+    """
+    sampled = sample_size is not None and len(df) > sample_size
+    if sampled:
+        df = df.sample(n=sample_size, random_state=0)
+
+    checker = DataQualityChecker(key_columns=key_columns, id_column=id_column)
+    report = checker.update(df)
+    report.sampled = sampled
+    return report
@@ -0,0 +1,95 @@
+import numpy as np
+import pandas as pd
+
+from pathlib import Path
+from typing import NamedTuple
+
+COMPONENTS = ["observed", "seasonal", "trend", "resid"]
+COLUMN_LEVELS = ["component", "value_key", "series"]
+
+# series ids: the total, then "<group>:<name>", e.g. "class:is_herbicide"
+TOTAL_SERIES = "total"
+
+
+class SeriesComponents(NamedTuple):
+    # same fields as statsmodels' DecomposeResult, without importing it
+    observed: pd.Series
+    seasonal: pd.Series
+    trend: pd.Series
+    resid: pd.Series
+
+
+def series_id(group: str, name: str) -> str:
+    return f"{group}:{name}"
+
+
+def split_series_id(series: str) -> tuple:
+    """
+    (group, name) of a series id, (None, "total") for the total.
+    """
+    group, _, name = series.rpartition(":")
+    return group or None, name
+
+
+class SeriesDecompositions:
+    """
+    Seasonal, trend and residual components of many monthly series, computed
+    in a single batched pass over a month x (value_key, series) matrix.
+    """
+
+    def __init__(self, components: pd.DataFrame):
+        # month x (component, value_key, series)
+        self.components = components
+
+    @classmethod
+    def from_monthly(cls, monthly: pd.DataFrame, period: int) -> "SeriesDecompositions":
+        """
+        Decompose every (value_key, series) column of a dense monthly frame.
+        Frames shorter than two periods cannot be decomposed: their seasonal,
+        trend and residual components are left NaN.
+        """
+        values = monthly.to_numpy(dtype=float)
+        if len(monthly) >= 2 * period and monthly.shape[1] > 0:
+            from statsmodels.tsa.seasonal import seasonal_decompose  # slow import
+
+            result = seasonal_decompose(values, period=period)
+            arrays = {component: getattr(result, component) for component in COMPONENTS}
+        else:
+            arrays = {
+                component: np.full(values.shape, np.nan) for component in COMPONENTS
+            }
+            arrays["observed"] = values
+        components = pd.concat(
+            {
+                component: pd.DataFrame(
+                    arrays[component], index=monthly.index, columns=monthly.columns
+                )
+                for component in COMPONENTS
+            },
+            axis=1,
+            names=COLUMN_LEVELS[:1],
+        )
+        return cls(components)
+
+    def series_names(self, value_key: str) -> list:
+        return list(self.components["observed"][value_key].columns)
+
+    def get(self, value_key: str, series: str = TOTAL_SERIES) -> SeriesComponents:
+        """
+        Components of one series.
+        """
+        return SeriesComponents(
+            *(
+                self.components[(component, value_key, series)]
+                for component in COMPONENTS
+            )
+        )
+
+    def save(self, path):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.components.to_parquet(path)
+
+    @classmethod
+    def load(cls, path) -> "SeriesDecompositions":
+        return cls(pd.read_parquet(path))
@@ -1,35 +1,150 @@
-import requests
 import json
+import copy
+import hashlib
+import logging
+import multiprocessing
+import os
+import time
+import re
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
 import warnings
 
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from datetime import datetime
-from statsmodels.tsa.seasonal import seasonal_decompose
+from functools import lru_cache, partial
+from pathlib import Path
+from typing import TYPE_CHECKING, NamedTuple
+
+import instrumentation
+from ncm_prefix_index import NcmPrefixIndex
+from decomposition import TOTAL_SERIES, SeriesDecompositions, series_id
+from incremental_aggregate import IncrementalAggregate, concat_categorical_frames
+from data_quality import (
+    VALID_CONSEQUENCE_LEVELS,
+    DataQualityReport,
+    check_frame,
+)
+from partition_store import DEFAULT_STORE_DIR, PartitionedStore, hash_records
+from query_backend import QueryBackend, create_query_backend
+from rollup import CLASS_DIMENSION, RollupCube
+from snapshot_store import DEFAULT_SNAPSHOT_DIR, SnapshotStore
+
+LOGGER = logging.getLogger("comexstat_viz.fetch")
+
+# The network stack (comexstat_client, requests, ijson) and statsmodels are
+# imported by the functions using them, so reading a snapshot loads neither.
+# Type checkers import the classes of their annotations
+if TYPE_CHECKING:
+    from comexstat_client import FilterCache, SingleFlight
+    from statsmodels.tsa.seasonal import DecomposeResult
 
 DATA_QUALITY_CHECK_CONSEQUENCE = "warning"
+DATA_QUALITY_SAMPLE_SIZE = None  # rows; None checks every row
+
+FIRST_AVAILABLE_YEAR = 1997  # this database starts in 1997
+START_YEAR = FIRST_AVAILABLE_YEAR
+END_YEAR = 2024
+
+# partitioned fetching: one request per (year, NCM prefix)
+NCM_PARTITION_PREFIX_LENGTH = 5
+FETCH_MAX_WORKERS = 8
+FETCH_MAX_RETRIES = 3
+FETCH_BACKOFF_SECONDS = 2.0
+
+# streaming ingestion: records are parsed into arrow batches of this size
+INGEST_BATCH_SIZE = 50_000
+
+# processing: large frames are processed per year in a process pool. The
+# steps are vectorized over categories (~0.8s for 3.6M rows on one core), so
+# below PROCESS_POOL_MIN_ROWS spawning the workers costs more than it saves.
+# Measure with `benchmark.py --workers 1 2 4 8`
+PROCESS_PARTITION_KEY = "year"
+PROCESS_MAX_WORKERS = os.cpu_count()
+PROCESS_POOL_MIN_ROWS = 10_000_000
 
 PRODUCT_IDENTIFIER_COLUMN_NAME = "id_ncm"
 
-# POSSIBLE_METRICS = ["FOB", "KG", "Statistic", "Freight", "Insurance", "CIF"]
-POSSIBLE_METRICS = ["KG"]  # TODO allow every metric
+# every metric is requested in the same query
+POSSIBLE_METRICS = ["FOB", "KG", "Statistic", "Freight", "Insurance", "CIF"]
+# raw API columns of every metric
+METRIC_COLUMNS = {
+    "FOB": ["vlFob"],
+    "KG": ["kgLiquido"],
+    "Statistic": ["qtEstat", "noUnid"],
+    "Freight": ["vlFrete"],
+    "Insurance": ["vlSeguro"],
+    "CIF": ["vlCif"],
+}
 
-ANALYSIS_VALUE_KEYS = ["net_weight_kg"]
+# aggregated together, as one numeric block. The first one is the default
+ANALYSIS_VALUE_KEYS = [
+    "net_weight_kg",
+    "value_fob_usd",
+    "value_frete_usd",
+    "value_insurance_usd",
+    "value_cif_usd",
+    "statistical_quantity",
+]
 ANALYSIS_DT_KEY = "dt"
+MONTHS_PER_YEAR = 12  # seasonal period
+# default product classes of a spec (see DatasetSpec.class_keys)
+ANALYSIS_CLASS_KEYS = [
+    "is_domissanitario",
+    "is_herbicide",
+    "is_inseticide",
+    "is_fungicide",
+]
+ROLLUP_DIMENSIONS = [
+    "export_country_code",
+    "import_brazillian_state",
+    "transport_method",
+]
+# seasonal decompositions: total, every class and the top countries per metric
+SEASONAL_COUNTRY_KEY = "export_country_code"
+SEASONAL_TOP_COUNTRIES = 10
+SEASONAL_DERIVED_NAME = "seasonal"
+# processed records and rollup cube, updated in place with the months that
+# changed
+RECORDS_DERIVED_NAME = "records"
+ROLLUP_CUBE_DERIVED_NAME = "rollup_cube"
+# part of every dataset version: bump it when processing, aggregation or the
+# snapshot frames change, so existing snapshots and derived results are rebuilt
+PIPELINE_VERSION = 1
 
 # NCM stands for "Nomenclatura Comum Mercosul"
 # https://portalunico.siscomex.gov.br/classif/#/nesh/consulta?id=114967&dataPesquisa=2025-01-10T19:55:04.000Z&tipoNota=3&tab=11736538995258
 
+# classification -> NCM prefixes. Several prefixes may share a classification
 NCM_IDS_PREFIX_DICT = {
-    "PESTICIDES": "38081",
-    "FUNGICIDES": "38082",
-    "HERBICIDES": "38083",
-    "DESINFETANTES": "38084",
-    "UNCLEAR": "38085",  # TODO descobrir oq é o 85
-    "OTHERS": "38089",
-    "DDT": "29039220",  # NOT A PREFIX ..... but will work
-    "DDT": "29036220",  # NOT A PREFIX .....
+    "PESTICIDES": ["38081"],
+    "FUNGICIDES": ["38082"],
+    "HERBICIDES": ["38083"],
+    "DESINFETANTES": ["38084"],
+    "UNCLEAR": ["38085"],  # TODO descobrir oq é o 85
+    "OTHERS": ["38089"],
+    "DDT": ["29039220", "29036220"],  # NOT A PREFIX ..... but will work
 }
 
+# one hot classes from the (lowered) NCM description
+DESCRIPTION_CLASS_PATTERNS = {
+    "is_domissanitario": "domissanit",
+    "is_herbicide": "herbicida|germina",
+    "is_inseticide": "inseticid",
+    "is_fungicide": "fungicid",
+    "is_ddt": "ddt",  # unused. values were too low in exploratory analysis
+}
+COMBINED_CLASS_PATTERN = re.compile(
+    "|".join(
+        f"(?P<{class_key}>{pattern})"
+        for class_key, pattern in DESCRIPTION_CLASS_PATTERNS.items()
+    )
+)
+PESTICIDE_CLASS_COLUMNS = ["is_herbicide", "is_inseticide", "is_fungicide"]
+
 COLUMN_RENAME_MAP = {
     "coAno": "year",
     "coMes": "month",
@@ -48,7 +163,44 @@ COLUMN_RENAME_MAP = {
     "qtEstat": "statistical_quantity",
 }
 
-BASE_URL = "https://api-comexstat.mdic.gov.br/general"
+# compact in-memory schema of the renamed frame. Text columns have a tiny
+# cardinality compared to the row count, so they are kept as categoricals
+CATEGORICAL_COLUMNS = [
+    "export_country",
+    "import_brazillian_state",
+    "transport_method",
+    "federal_agency",
+    PRODUCT_IDENTIFIER_COLUMN_NAME,
+    "description_ncm",
+    "unit",
+]
+INTEGER_COLUMN_TYPES = {"year": "int16", "month": "int8"}
+VALUE_COLUMNS = [
+    "value_fob_usd",
+    "value_frete_usd",
+    "value_insurance_usd",
+    "value_cif_usd",
+    "net_weight_kg",
+    "statistical_quantity",
+]
+USE_FLOAT32_VALUES = False  # halves the value columns, at ~7 significant digits
+
+# arrow types of the raw API columns. Anything not listed is kept as a string
+RAW_COLUMN_TYPES = {
+    "coAno": pa.int16(),
+    "coMes": pa.int8(),
+    "vlFob": pa.float64(),
+    "vlFrete": pa.float64(),
+    "vlSeguro": pa.float64(),
+    "vlCif": pa.float64(),
+    "kgLiquido": pa.float64(),
+    "qtEstat": pa.float64(),
+}
+
+# COMEXSTAT_BASE_URL points the pipeline at another server, e.g. mock_comexstat.py
+BASE_URL = os.environ.get(
+    "COMEXSTAT_BASE_URL", "https://api-comexstat.mdic.gov.br/general"
+)
 
 HEADERS = {"Accept": "application/json", "Content-Type": "application/json"}
 
@@ -110,6 +262,21 @@ DEFAULT_FILTER_PARAMS = {
     "monthEndName": "Dezembro",
 }
 
+MONTH_NAMES_PT = [
+    "Janeiro",
+    "Fevereiro",
+    "Março",
+    "Abril",
+    "Maio",
+    "Junho",
+    "Julho",
+    "Agosto",
+    "Setembro",
+    "Outubro",
+    "Novembro",
+    "Dezembro",
+]
+
 COUNTRY_PT_TO_ISO3_CODE_MAP = {  # TODO dimensions file with this kind of mapping
     "Alemanha": "DEU",  # Germany
     "Antilhas Holandesas": "ANT",  # Netherlands Antilles (Note: This entity no longer exists as a country)
@@ -185,17 +352,142 @@ COUNTRY_PT_TO_ISO3_CODE_MAP = {  # TODO dimensions file with this kind of mappin
     "Índia": "IND",  # India
 }
 
+# detail columns ("detailDatabase") the records can be broken down by. The
+# NCM is always requested, products are classified by it
+DETAIL_COLUMN_IDS = [detail["id"] for detail in DEFAULT_FILTER_PARAMS["detailDatabase"]]
+NCM_DETAIL_COLUMN_ID = "noNcmpt"
+
+
+class DatasetSpec(NamedTuple):
+    """
+    A dataset of the dashboards: the NCM products it covers, its years,
+    detail columns and metrics.
+
+    Every spec is fetched, processed and cached (snapshots, derived results)
+    on its own. Specs with the same detail columns share a partitioned store
+    (see dataset_store), whose partitions are fetched for every product of
+    their NCM prefix and every metric, then narrowed to the spec: a month
+    fetched for one spec is reused by any other spec covering that prefix.
+    """
+
+    name: str
+    # classification -> NCM prefixes, see create_id_to_classification_map
+    prefix_dict: dict
+    start_year: int = START_YEAR
+    end_year: int = END_YEAR
+    detail_columns: tuple = tuple(DETAIL_COLUMN_IDS)
+    metrics: tuple = tuple(POSSIBLE_METRICS)
+    # one hot product classes the records are rolled up and decomposed on:
+    # description classes (DESCRIPTION_CLASS_PATTERNS) or classifications of
+    # prefix_dict (see prefix_class_key)
+    class_keys: tuple = tuple(ANALYSIS_CLASS_KEYS)
+
+
+def prefix_class_key(classification: str) -> str:
+    """
+    One hot column of the records of a prefix_dict classification.
+    """
+    return f"is_ncm_{classification.lower()}"
+
+
+FERTILIZERS_PREFIX_DICT = {
+    "ORGANIC": ["3101"],
+    "NITROGENOUS": ["3102"],
+    "PHOSPHATIC": ["3103"],
+    "POTASSIC": ["3104"],
+    "MIXED": ["3105"],
+}
+PESTICIDES_DATASET = DatasetSpec("pesticides", NCM_IDS_PREFIX_DICT)
+FERTILIZERS_DATASET = DatasetSpec(
+    "fertilizers",
+    FERTILIZERS_PREFIX_DICT,
+    class_keys=tuple(map(prefix_class_key, FERTILIZERS_PREFIX_DICT)),
+)
+DATASET_SPECS = {spec.name: spec for spec in [PESTICIDES_DATASET, FERTILIZERS_DATASET]}
+
+
+class ComexstatQuery(NamedTuple):
+    """
+    Immutable, hashable query of the COMEXSTAT general endpoint. Built with
+    create(), which sorts and deduplicates the NCM ids and metrics, so equal
+    queries have the same filter and key whatever the order they were given
+    in.
+    """
+
+    ncm_ids: tuple
+    metrics: tuple
+    start_year: int
+    end_year: int
+    start_month: int = 1
+    end_month: int = 12
+    detail_columns: tuple = tuple(DETAIL_COLUMN_IDS)
+
+    @classmethod
+    def create(
+        cls,
+        ncm_ids,
+        metrics,
+        start_year: int,
+        end_year: int,
+        start_month: int = 1,
+        end_month: int = 12,
+        detail_columns=DETAIL_COLUMN_IDS,
+    ) -> "ComexstatQuery":
+        unknown = set(detail_columns) - set(DETAIL_COLUMN_IDS)
+        if unknown:
+            raise ValueError(f"Unknown detail columns {unknown}")
+        return cls(
+            ncm_ids=tuple(sorted(set(ncm_ids))),
+            metrics=tuple(sorted(set(metrics))),
+            start_year=int(start_year),
+            end_year=int(end_year),
+            start_month=int(start_month),
+            end_month=int(end_month),
+            # in the order of DEFAULT_FILTER_PARAMS, the order of the columns
+            detail_columns=tuple(
+                column for column in DETAIL_COLUMN_IDS if column in detail_columns
+            ),
+        )
+
+    def filter_params(self) -> dict:
+        """
+        A new filter dict, the query's own to modify.
+        """
+        return build_query_filter_params(
+            ncm_produt_ids=self.ncm_ids,
+            metrics_columns=self.metrics,
+            start_year=self.start_year,
+            end_year=self.end_year,
+            default_params=detail_filter_params(self.detail_columns),
+            start_month=self.start_month,
+            end_month=self.end_month,
+        )
+
+    def serialize(self) -> str:
+        return serialize_filter_params(self.filter_params())
+
+    def key(self, base_url=BASE_URL) -> str:
+        """
+        Stable hash of the request, e.g. to cache its response on.
+        """
+        serialized = f"{base_url}|{self.serialize()}".encode()
+        return hashlib.sha1(serialized).hexdigest()[:16]
+
 
 def get_comexstat_filter_possible_values(
     filter_name: str,
     base_url=BASE_URL,
+    filter_cache: "FilterCache" = None,
 ) -> list:
+    import comexstat_client as client
+
     endpoint = "filters"
 
     url = f"{base_url}/{endpoint}/{filter_name}"
-    r = requests.get(url, verify=False)  ## DO NOT DO THIS
+    filter_cache = filter_cache or client.FilterCache()
+    payload = filter_cache.get(url, filter_name=filter_name)
 
-    return r.json()["data"][0]
+    return payload["data"][0]
 
 
 def create_id_to_classification_map(
@@ -206,20 +498,21 @@ def create_id_to_classification_map(
 
     Args:
         response_data (list): List of dictionaries containing 'id'.
-        prefix_dict (dict): Dictionary of prefixes to match.
+        prefix_dict (dict): Dictionary of classification to prefixes to match.
+            The longest matching prefix wins.
 
     Returns:
         dict: A dictionary mapping IDs to their classification.
     """
+    prefix_index = NcmPrefixIndex.from_label_prefixes(prefix_dict)
     id_to_classification = {}
 
     for item in response_data:
         item_id = item["id"]  # ID is a string
 
-        for classification, prefix in prefix_dict.items():
-            if item_id.startswith(prefix):
-                id_to_classification[item["id"]] = classification
-                break
+        classification = prefix_index.get(item_id)
+        if classification is not None:
+            id_to_classification[item_id] = classification
 
     return id_to_classification
 
@@ -229,17 +522,272 @@ def build_query_filter_params(
     metrics_columns: list,
     start_year: int,
     end_year: int,
-    default_params: dict,
-):
-    default_params["filterArray"] = [
-        {"item": ncm_produt_ids, "idInput": "noNcmpt"}
+    default_params: dict = DEFAULT_FILTER_PARAMS,
+    start_month: int = 1,
+    end_month: int = 12,
+) -> dict:
+    """
+    Filter of a query, built on a copy of default_params: shared defaults
+    are never modified.
+    """
+    filter_params = copy.deepcopy(default_params)
+    filter_params["filterArray"] = [
+        {"item": list(ncm_produt_ids), "idInput": "noNcmpt"}
     ]  # do not hardcode  >:(
-    default_params["yearStart"] = start_year
-    default_params["yearEnd"] = end_year
+    filter_params["yearStart"] = start_year
+    filter_params["yearEnd"] = end_year
+    filter_params["monthStart"] = f"{start_month:02d}"
+    filter_params["monthEnd"] = f"{end_month:02d}"
+    filter_params["monthStartName"] = MONTH_NAMES_PT[start_month - 1]
+    filter_params["monthEndName"] = MONTH_NAMES_PT[end_month - 1]
     for metric in metrics_columns:
-        default_params[f"metric{metric}"] = "true"
+        filter_params[f"metric{metric}"] = "true"
+
+    return filter_params
+
+
+def serialize_filter_params(filter_params: dict) -> str:
+    """
+    Canonical json of a filter: the same filter always gives the same string.
+    """
+    return json.dumps(filter_params, sort_keys=True, separators=(",", ":"))
+
+
+def validate_dataset_spec(spec: DatasetSpec):
+    if spec.start_year < FIRST_AVAILABLE_YEAR:
+        raise ValueError(f"Invalid start year {spec.start_year} of {spec.name}")
+    if spec.end_year < spec.start_year:
+        raise ValueError(f"Invalid end year {spec.end_year} of {spec.name}")
+    unknown = (set(spec.detail_columns) - set(DETAIL_COLUMN_IDS)) | (
+        set(spec.metrics) - set(POSSIBLE_METRICS)
+    )
+    if unknown:
+        raise ValueError(f"Unknown detail columns or metrics {unknown} of {spec.name}")
+    if NCM_DETAIL_COLUMN_ID not in spec.detail_columns:
+        raise ValueError(f"{spec.name} must be detailed by {NCM_DETAIL_COLUMN_ID}")
+    unknown = set(spec.class_keys) - set(DESCRIPTION_CLASS_PATTERNS).union(
+        map(prefix_class_key, spec.prefix_dict)
+    )
+    if unknown:
+        raise ValueError(f"Unknown class keys {unknown} of {spec.name}")
+
+
+def detail_filter_params(detail_columns: tuple) -> dict:
+    """
+    Copy of DEFAULT_FILTER_PARAMS requesting only the given detail columns.
+    """
+    params = copy.deepcopy(DEFAULT_FILTER_PARAMS)
+    params["detailDatabase"] = [
+        detail for detail in params["detailDatabase"] if detail["id"] in detail_columns
+    ]
+    return params
+
+
+def dataset_store(spec: DatasetSpec, root=DEFAULT_STORE_DIR) -> PartitionedStore:
+    """
+    Partitioned store of a spec, shared by every spec with the same detail
+    columns (their records have the same columns and granularity).
+    """
+    details = [column for column in DETAIL_COLUMN_IDS if column in spec.detail_columns]
+    return shared_partitioned_store(Path(root) / f"details={'-'.join(details)}")
+
+
+@lru_cache(maxsize=None)
+def shared_partitioned_store(root: Path) -> PartitionedStore:
+    """
+    A single store per directory and process: every spec using it sees, and
+    keeps in its manifest, the partitions written for the others.
+    """
+    return PartitionedStore(root)
+
+
+def dataset_snapshot_store(
+    spec: DatasetSpec, root=DEFAULT_SNAPSHOT_DIR
+) -> SnapshotStore:
+    return SnapshotStore(Path(root) / spec.name)
+
+
+def dataset_ncm_ids(spec: DatasetSpec, catalog: list = None) -> list:
+    """
+    NCM ids of the spec, from the (cached) NCM catalog.
+    """
+    if catalog is None:
+        catalog = get_comexstat_filter_possible_values(filter_name="ncm")
+    return list(create_id_to_classification_map(catalog, prefix_dict=spec.prefix_dict))
+
+
+def partition_ncm_ids(ncm_ids: list, catalog: list) -> list:
+    """
+    Every catalog id of the partition prefixes of ncm_ids: partitions are
+    fetched whole, so that any spec covering a prefix can reuse them.
+    """
+    prefixes = set(group_ids_by_prefix(ncm_ids))
+    return [
+        item["id"]
+        for item in catalog
+        if item["id"][:NCM_PARTITION_PREFIX_LENGTH] in prefixes
+    ]
+
+
+def select_dataset_records(
+    table: pa.Table, spec: DatasetSpec, ncm_ids: list
+) -> pa.Table:
+    """
+    Records of the spec NCM ids, without the columns of other metrics.
+    """
+    if table.num_rows == 0:
+        return table
+    table = table.filter(pc.is_in(table["coNcm"], value_set=pa.array(ncm_ids)))
+    return table.drop_columns(
+        [
+            column
+            for metric, columns in METRIC_COLUMNS.items()
+            if metric not in spec.metrics
+            for column in columns
+            if column in table.column_names
+        ]
+    )
+
+
+def dataset_version(store: PartitionedStore, spec: DatasetSpec, ncm_ids: list) -> str:
+    """
+    Version of the records of a spec in a shared store: changes with the
+    pipeline, the spec, its NCM ids or the stored months of its prefixes, but
+    not with the partitions of other specs.
+    """
+    prefixes = list(group_ids_by_prefix(ncm_ids))
+    content = {
+        "pipeline": PIPELINE_VERSION,
+        "spec": spec._asdict(),
+        "ncm_ids": sorted(ncm_ids),
+        "months": store.month_hashes(prefixes, spec.start_year, spec.end_year),
+    }
+    serialized = json.dumps(content, sort_keys=True).encode()
+    return hashlib.sha1(serialized).hexdigest()[:12]
+
+
+def dataset_value_keys(spec: DatasetSpec) -> list:
+    """
+    ANALYSIS_VALUE_KEYS of the spec metrics.
+    """
+    columns = {
+        COLUMN_RENAME_MAP[column]
+        for metric in spec.metrics
+        for column in METRIC_COLUMNS[metric]
+    }
+    return [value_key for value_key in ANALYSIS_VALUE_KEYS if value_key in columns]
+
 
-    return default_params
+def request_comexstat(
+    filter_params: dict,
+    base_url=BASE_URL,
+    headers=HEADERS,
+) -> dict:
+    """
+    GET the COMEXSTAT general endpoint. Raises on any request error.
+    """
+    import comexstat_client as client
+
+    params = {"filter": serialize_filter_params(filter_params)}
+    response = client.get(base_url, headers=headers, params=params)
+    response.raise_for_status()  # Raise HTTPError for bad responses
+    return response.json()
+
+
+def records_to_record_batch(records: list) -> pa.RecordBatch:
+    """
+    Build a typed arrow batch from a list of raw API records.
+    """
+    columns = list(records[0])
+    arrays = [
+        pa.array([record.get(column) for record in records]).cast(
+            RAW_COLUMN_TYPES.get(column, pa.string())
+        )
+        for column in columns
+    ]
+    return pa.RecordBatch.from_arrays(arrays, names=columns)
+
+
+def iter_record_batches(stream, batch_size: int = INGEST_BATCH_SIZE):
+    """
+    Incrementally parse the `data.list` array of a response stream, yielding
+    arrow batches. Peak memory is bounded by the batch size instead of the
+    whole response.
+    """
+    import ijson
+
+    batch = []
+    for record in ijson.items(stream, "data.list.item", use_float=True):
+        batch.append(record)
+        if len(batch) == batch_size:
+            yield records_to_record_batch(batch)
+            batch = []
+
+    if batch:
+        yield records_to_record_batch(batch)
+
+
+def stream_comexstat_table(
+    filter_params: dict,
+    base_url=BASE_URL,
+    headers=HEADERS,
+    batch_size: int = INGEST_BATCH_SIZE,
+) -> pa.Table:
+    """
+    GET the COMEXSTAT general endpoint and stream its records into an arrow
+    table. Raises on any request error.
+    """
+    import comexstat_client as client
+
+    params = {"filter": serialize_filter_params(filter_params)}
+    # read_seconds: waiting for the network, the rest is json decoding
+    with instrumentation.stage("fetch.stream") as record:
+        with client.get(
+            base_url, headers=headers, params=params, stream=True
+        ) as response:
+            response.raise_for_status()
+            response.raw.decode_content = True  # gzip
+            stream = instrumentation.CountingReader(response.raw)
+            batches = list(iter_record_batches(stream, batch_size=batch_size))
+
+        table = (
+            pa.Table.from_batches(batches).combine_chunks() if batches else pa.table({})
+        )
+        record.update(
+            rows=table.num_rows,
+            bytes=stream.bytes_read,
+            read_seconds=round(stream.read_seconds, 6),
+        )
+    return table
+
+
+@lru_cache(maxsize=None)
+def query_flights() -> "SingleFlight":
+    """
+    Single flight group of the COMEXSTAT queries of the process, created on
+    first use (the network stack is imported lazily).
+    """
+    import comexstat_client as client
+
+    return client.SingleFlight()
+
+
+def query_comexstat_table(
+    query: ComexstatQuery, base_url=BASE_URL, headers=HEADERS
+) -> pa.Table:
+    """
+    Records of a query, as stream_comexstat_table. Identical queries of any
+    thread or session are sent once: callers wait for the request in flight
+    and share its (read-only) table. Tables are then kept for up to 5 minutes
+    (within client.RESULT_CACHE_MAX_BYTES), so a result can be that stale.
+    """
+    return query_flights().do(
+        query.key(base_url),
+        stream_comexstat_table,
+        query.filter_params(),
+        base_url=base_url,
+        headers=headers,
+    )
 
 
 def query_defensivos_agricolas_from_comexstat(
@@ -252,8 +800,9 @@ def query_defensivos_agricolas_from_comexstat(
     default_params=DEFAULT_FILTER_PARAMS,
 ):
     assert (
-        start_year >= 1997
+        start_year >= FIRST_AVAILABLE_YEAR
     ), """Invalid start year. This database starts in 1997"""  # i could check many more things
+    import requests
 
     filter_params = build_query_filter_params(
         ncm_produt_ids=ncm_produt_ids,
@@ -263,37 +812,320 @@ def query_defensivos_agricolas_from_comexstat(
         default_params=default_params,
     )
 
-    params = {"filter": json.dumps(filter_params)}
     try:
-        response = requests.get(
-            base_url, headers=headers, params=params, verify=False
-        )  ## investigate SSL for this api. No documentation explaining
-        response.raise_for_status()  # Raise HTTPError for bad responses
-        return response.json()
+        return request_comexstat(filter_params, base_url=base_url, headers=headers)
 
     except requests.exceptions.RequestException as e:
         print(f"An error occurred: {e}")
         return None
 
 
-def check_data_quality(df, consequence_level="warning"):
+def fetch_retryable_errors() -> tuple:
+    """
+    Errors worth retrying a partition for. A connection can also break while
+    the body is being streamed.
+    """
+    import ijson
+    import requests
+    import urllib3
+
+    return (
+        requests.exceptions.RequestException,
+        urllib3.exceptions.HTTPError,
+        ijson.JSONError,
+    )
+
+
+class FetchPartition(NamedTuple):
+    year: int
+    prefix: str
+    ncm_ids: list
+    start_month: int = 1
+    end_month: int = 12
+
+
+def group_ids_by_prefix(
+    ncm_produt_ids: list, prefix_length: int = NCM_PARTITION_PREFIX_LENGTH
+) -> dict:
+    ids_by_prefix = defaultdict(list)
+    for ncm_id in ncm_produt_ids:
+        ids_by_prefix[ncm_id[:prefix_length]].append(ncm_id)
+
+    return dict(sorted(ids_by_prefix.items()))
+
+
+def build_fetch_partitions(
+    ncm_produt_ids: list,
+    start_year: int,
+    end_year: int,
+    prefix_length: int = NCM_PARTITION_PREFIX_LENGTH,
+) -> list:
+    """
+    Split a query into one partition per (year, NCM prefix).
+    """
+    ids_by_prefix = group_ids_by_prefix(ncm_produt_ids, prefix_length)
+
+    return [
+        FetchPartition(year, prefix, ids)
+        for year in range(start_year, end_year + 1)
+        for prefix, ids in ids_by_prefix.items()
+    ]
+
+
+def query_comexstat_partition(
+    partition: FetchPartition,
+    metrics_columns: list,
+    max_retries: int = FETCH_MAX_RETRIES,
+    backoff_seconds: float = FETCH_BACKOFF_SECONDS,
+    base_url=BASE_URL,
+    headers=HEADERS,
+    detail_columns=DETAIL_COLUMN_IDS,
+) -> pa.Table:
+    """
+    Fetch the records of a single partition, retrying with exponential
+    backoff. Raises once the retries are exhausted.
+    """
+    year, prefix = partition.year, partition.prefix
+    query = ComexstatQuery.create(
+        partition.ncm_ids,
+        metrics_columns,
+        start_year=year,
+        end_year=year,
+        start_month=partition.start_month,
+        end_month=partition.end_month,
+        detail_columns=detail_columns,
+    )
+
+    with instrumentation.stage("fetch.partition", year=year, prefix=prefix) as record:
+        for attempt in range(max_retries + 1):
+            record["attempts"] = attempt + 1
+            try:
+                return query_comexstat_table(query, base_url=base_url, headers=headers)
+
+            except fetch_retryable_errors() as e:
+                if attempt == max_retries:
+                    raise
+                wait = backoff_seconds * 2**attempt
+                LOGGER.warning(
+                    "Partition %s/%s failed (%s). Retrying in %ss",
+                    year,
+                    prefix,
+                    e,
+                    wait,
+                )
+                time.sleep(wait)
+
+
+def fetch_partitions(
+    partitions: list,
+    metrics_columns: list,
+    max_workers: int = FETCH_MAX_WORKERS,
+    **partition_kwargs,
+):
+    """
+    Fetch partitions concurrently on a bounded thread pool, yielding
+    (partition, arrow table) as each one completes.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        future_to_partition = {
+            executor.submit(
+                query_comexstat_partition,
+                partition,
+                metrics_columns,
+                **partition_kwargs,
+            ): partition
+            for partition in partitions
+        }
+        for future in as_completed(future_to_partition):
+            yield future_to_partition[future], future.result()
+
+
+@instrumentation.instrumented("fetch")
+def query_defensivos_agricolas_partitioned(
+    ncm_produt_ids: list,
+    metrics_columns: list,
+    start_year: int,
+    end_year: int,
+    max_workers: int = FETCH_MAX_WORKERS,
+    **partition_kwargs,
+) -> pa.Table:
+    """
+    Fetch a year range as many small (year, NCM prefix) requests on a bounded
+    thread pool and merge their records. Only failed partitions are retried.
+    """
+    assert (
+        start_year >= FIRST_AVAILABLE_YEAR
+    ), """Invalid start year. This database starts in 1997"""
+
+    partitions = build_fetch_partitions(ncm_produt_ids, start_year, end_year)
+
+    tables = [
+        table
+        for _, table in fetch_partitions(
+            partitions, metrics_columns, max_workers=max_workers, **partition_kwargs
+        )
+    ]
+
+    return pa.concat_tables(tables, promote_options="default")
+
+
+@instrumentation.instrumented("fetch.sync")
+def sync_partitioned_store(
+    store: PartitionedStore,
+    ncm_produt_ids: list,
+    metrics_columns: list,
+    start_year: int,
+    end_year: int,
+    max_workers: int = FETCH_MAX_WORKERS,
+    **partition_kwargs,
+) -> int:
+    """
+    Fetch only the months missing from the store, or still revisable, and
+    write them to it. Returns the number of requested partitions.
+    """
+    assert (
+        start_year >= FIRST_AVAILABLE_YEAR
+    ), """Invalid start year. This database starts in 1997"""
+
+    partitions = []
+    for prefix, ids in group_ids_by_prefix(ncm_produt_ids).items():
+        for year in range(start_year, end_year + 1):
+            stale_months = store.stale_months(prefix, year, ids, metrics_columns)
+            if stale_months:
+                partitions.append(
+                    FetchPartition(
+                        year, prefix, ids, min(stale_months), max(stale_months)
+                    )
+                )
+
+    for partition, table in fetch_partitions(
+        partitions, metrics_columns, max_workers=max_workers, **partition_kwargs
+    ):
+        df_partition = table.to_pandas()
+        months = (
+            df_partition["coMes"].astype(int)
+            if not df_partition.empty
+            else pd.Series(dtype=int)
+        )
+        for month in range(partition.start_month, partition.end_month + 1):
+            df_month = df_partition[months.values == month]
+            store.write_partition(
+                partition.prefix,
+                partition.year,
+                month,
+                df_month,
+                ncm_ids=partition.ncm_ids,
+                metrics_columns=metrics_columns,
+                # checked once, as it arrives. Months never share a row
+                quality_report=check_frame(df_month, id_column="coNcm"),
+            )
+        store.save_manifest()  # keep progress if a later partition fails
+
+    return len(partitions)
+
+
+def sync_dataset_store(
+    store: PartitionedStore, spec: DatasetSpec, catalog: list = None
+) -> list:
+    """
+    Sync the partitions a spec reads (whole NCM prefixes, every metric, see
+    dataset_store) and return the NCM ids of the spec. Nothing is requested
+    when the store is up to date.
+    """
+    validate_dataset_spec(spec)
+    catalog = catalog or get_comexstat_filter_possible_values(filter_name="ncm")
+    ncm_ids = dataset_ncm_ids(spec, catalog=catalog)
+    sync_partitioned_store(
+        store,
+        ncm_produt_ids=partition_ncm_ids(ncm_ids, catalog),
+        metrics_columns=POSSIBLE_METRICS,
+        start_year=spec.start_year,
+        end_year=spec.end_year,
+        detail_columns=spec.detail_columns,
+    )
+    return ncm_ids
+
+
+def dataset_quality_report(
+    store: PartitionedStore, spec: DatasetSpec, ncm_ids: list
+) -> DataQualityReport:
+    """
+    Data quality of the stored records of a spec, from the checks done when
+    each month was stored, narrowed to the NCM ids of the spec.
+    """
+    return store.quality_report(
+        list(group_ids_by_prefix(ncm_ids)),
+        start_year=spec.start_year,
+        end_year=spec.end_year,
+        ncm_ids=ncm_ids,
+    )
+
+
+def memory_usage_mb(df: pd.DataFrame) -> float:
+    """
+    Shallow size of a frame: object strings are not walked (see
+    instrumentation.result_size).
+    """
+    return df.memory_usage().sum() / 1e6
+
+
+@instrumentation.instrumented("build_frame")
+def apply_compact_schema(
+    df: pd.DataFrame, float32_values: bool = USE_FLOAT32_VALUES
+) -> pd.DataFrame:
+    """
+    Cast low cardinality text to categoricals, year/month to small integers
+    and, optionally, values to float32. Columns that are absent are skipped.
+    """
+    value_type = "float32" if float32_values else "float64"
+    dtypes = {
+        **{column: "category" for column in CATEGORICAL_COLUMNS},
+        **INTEGER_COLUMN_TYPES,
+        **{column: value_type for column in VALUE_COLUMNS},
+    }
+    dtypes = {column: dtype for column, dtype in dtypes.items() if column in df}
+
+    return df.astype(dtypes)
+
+
+def check_data_quality(
+    df,
+    consequence_level="warning",
+    sample_size: int = DATA_QUALITY_SAMPLE_SIZE,
+    key_columns: list = None,
+) -> DataQualityReport:
     """
     Check for NaN values and duplicates in a DataFrame.
+    Duplicates are found from 64 bit row fingerprints of the key columns
+    (all by default). With a sample_size only a random sample is checked.
     """
-    valid_levels = {"warning", "error"}
+    validate_consequence_level(consequence_level)
+    with instrumentation.stage("quality_check", rows=len(df)) as record:
+        report = check_frame(df, key_columns=key_columns, sample_size=sample_size)
+        record["issues"] = len(report.issues())
+    handle_data_quality_report(report, consequence_level=consequence_level)
+
+    return report
+
+
+def validate_consequence_level(consequence_level: str):
+    valid_levels = VALID_CONSEQUENCE_LEVELS
     if consequence_level not in valid_levels:
         raise ValueError(
             f"Invalid consequence_level: '{consequence_level}'. "
             f"Must be one of {valid_levels}"
         )
 
-    issues = []
-
-    if df.isna().any().any():
-        issues.append("NaN values detected in the DataFrame.")
 
-    if df.duplicated().any():
-        issues.append("Duplicate rows detected in the DataFrame.")
+def handle_data_quality_report(
+    report: DataQualityReport, consequence_level: str = "warning"
+):
+    """
+    Warn or raise, depending on the consequence level, when a report (e.g.
+    merged from per partition checks) has issues.
+    """
+    validate_consequence_level(consequence_level)
+    issues = report.issues() if report.has_issues else []
 
     if issues:
         full_message = " ".join(issues)
@@ -308,102 +1140,322 @@ def check_data_quality(df, consequence_level="warning"):
 
 
 def map_column_to_iso3_country_code(column: pd.Series):
-    return column.map(COUNTRY_PT_TO_ISO3_CODE_MAP)
+    return map_categories(column, COUNTRY_PT_TO_ISO3_CODE_MAP)
 
 
+def month_start_dates(year: pd.Series, month: pd.Series) -> np.ndarray:
+    """
+    First day of every (year, month). Rows are turned into month numbers with
+    integer arithmetic, then pick their date in a lookup of the few hundred
+    months spanned, instead of building a date per row.
+    """
+    months = (
+        year.to_numpy(dtype=np.int64) * MONTHS_PER_YEAR
+        + month.to_numpy(dtype=np.int64)
+        - 1
+    )
+    if len(months) == 0:
+        return np.array([], dtype="datetime64[ns]")
+
+    first_month = months.min()
+    lookup = (
+        (np.arange(first_month, months.max() + 1) - 1970 * MONTHS_PER_YEAR)
+        .astype("datetime64[M]")
+        .astype("datetime64[ns]")
+    )
+    return lookup[months - first_month]
+
+
+@instrumentation.instrumented("process")
 def process_defensivos_agricolas_df(df: pd.DataFrame):
     """
-    Lower description strings, Enforce dtype and add Date columns
+    Lower description strings and add Date columns.
+    Expects the compact schema (see apply_compact_schema).
+    The extraction time is stored once, in `df.attrs["extracted_at"]`.
     """
-    _df = df.copy()
+    # shallow: assigning a column replaces it in _df only, df is left as is
+    _df = df.copy(deep=False)
     # is this bad hardcoding?
-    _df["description_ncm"] = _df["description_ncm"].str.lower()
-    _df["net_weight_kg"] = _df["net_weight_kg"].astype(float)
-    _df["dt"] = pd.to_datetime(_df["year"] + "-" + _df["month"] + "-01")
-    _df["extracted_at"] = datetime.today()
-    _df["export_country_code"] = map_column_to_iso3_country_code(_df["export_country"])
+    # mapping through categories: once per distinct description / country
+    _df["description_ncm"] = map_categories(_df["description_ncm"], str.lower)
+    _df["dt"] = month_start_dates(_df["year"], _df["month"])
+    _df.attrs["extracted_at"] = datetime.today().isoformat()
+    if "export_country" in _df:
+        _df["export_country_code"] = map_column_to_iso3_country_code(
+            _df["export_country"]
+        )
 
     return _df
 
 
-def create_one_hot_classification(df: pd.DataFrame):
-    _df = df.copy()
+def map_categories(column: pd.Series, mapper) -> pd.Series:
+    """
+    Map a column through its distinct values only, returning a categorical.
+    Unmapped values become NaN.
+    """
+    column = column.astype("category")
+    mapped = pd.Categorical(column.cat.categories.map(mapper))
+    # the extra last entry is picked by the -1 code of missing values
+    lookup = np.append(mapped.codes, -1).astype(mapped.codes.dtype)
+    mapped_codes = lookup[column.cat.codes.to_numpy()]
+
+    return pd.Series(
+        pd.Categorical.from_codes(mapped_codes, mapped.categories, validate=False),
+        index=column.index,
+        name=column.name,
+    )
+
+
+@lru_cache(maxsize=None)
+def classify_description(description: str) -> tuple:
+    """
+    One hot classes of a single (lowered) NCM description, in the order of
+    DESCRIPTION_CLASS_PATTERNS. Scans the description once with the combined
+    pattern.
+    """
+    matched = {
+        match.lastgroup for match in COMBINED_CLASS_PATTERN.finditer(description)
+    }
+    return tuple(class_key in matched for class_key in DESCRIPTION_CLASS_PATTERNS)
 
-    # one hot categories
-    _df["is_domissanitario"] = False
-    _df["is_herbicide"] = False
-    _df["is_inseticide"] = False
-    _df["is_fungicide"] = False
-    _df["is_ddt"] = False  # unused. values were too low in exploratory analysis
 
-    domissanit_cond = _df["description_ncm"].str.contains("domissanit")
-    _df.loc[domissanit_cond, "is_domissanitario"] = True
+def build_description_class_table(descriptions: pd.Index) -> pd.DataFrame:
+    """
+    Lookup table from each distinct description to its one hot classes.
+    """
+    return pd.DataFrame(
+        [classify_description(description) for description in descriptions],
+        index=descriptions,
+        columns=list(DESCRIPTION_CLASS_PATTERNS),
+        dtype=bool,
+    )
 
-    herbicide_cond = _df["description_ncm"].str.contains("herbicida|germina")
-    _df.loc[herbicide_cond, "is_herbicide"] = True
 
-    inseticide_cond = _df["description_ncm"].str.contains("inseticid")
-    _df.loc[inseticide_cond, "is_inseticide"] = True
+@instrumentation.instrumented("classify")
+def create_one_hot_classification(
+    df: pd.DataFrame, prefix_dict: dict = NCM_IDS_PREFIX_DICT, class_keys: tuple = ()
+):
+    """
+    Add one hot product class columns (and the NCM prefix class, from
+    prefix_dict, one hot too for the classifications in class_keys, see
+    prefix_class_key).
 
-    fungicide_cond = _df["description_ncm"].str.contains("fungicid")
-    _df.loc[fungicide_cond, "is_fungicide"] = True
+    Distinct descriptions and NCM ids are classified once, then broadcast to
+    the rows through their categorical codes, so the cost scales with the
+    number of distinct products instead of the number of records.
+    """
+    _df = df.copy(deep=False)  # shallow: the new columns are added to _df only
 
-    ddt_cond = _df["description_ncm"].str.contains("ddt")
-    _df.loc[ddt_cond, "is_ddt"] = True
+    descriptions = _df["description_ncm"].astype("category")
+    class_table = build_description_class_table(descriptions.cat.categories)
+    # an extra all False row, picked by the -1 code of missing descriptions
+    lookup = np.vstack(
+        [class_table.to_numpy(), np.zeros((1, class_table.shape[1]), dtype=bool)]
+    )
+    one_hot = lookup[descriptions.cat.codes.to_numpy()]
+    for i, class_key in enumerate(class_table.columns):
+        _df[class_key] = one_hot[:, i]
 
     # multiple categories
-    _df["is_multiple_categories"] = False
-    pesticide_classes_cols = ["is_herbicide", "is_inseticide", "is_fungicide"]
-    multiple_cond = _df[pesticide_classes_cols].sum(axis=1) > 1
-    _df.loc[multiple_cond, "is_multiple_categories"] = True
+    _df["is_multiple_categories"] = _df[PESTICIDE_CLASS_COLUMNS].sum(axis=1) > 1
+
+    # class of the NCM prefix the product was selected by
+    ncm_ids = _df[PRODUCT_IDENTIFIER_COLUMN_NAME].astype("category")
+    id_to_classification = create_id_to_classification_map(
+        [{"id": ncm_id} for ncm_id in ncm_ids.cat.categories], prefix_dict=prefix_dict
+    )
+    _df["ncm_class"] = map_categories(ncm_ids, id_to_classification)
+    for classification in prefix_dict:
+        if prefix_class_key(classification) in class_keys:
+            _df[prefix_class_key(classification)] = (
+                _df["ncm_class"] == classification
+            ).to_numpy()
 
     return _df
 
 
-def create_denfensivos_agricolas_df(consequence_level: str = DATA_QUALITY_CHECK_CONSEQUENCE) -> pd.DataFrame:
-    possible_ncm_ids = get_comexstat_filter_possible_values(filter_name="ncm")
-    id_to_classification_map = create_id_to_classification_map(
-        response_data=possible_ncm_ids
+@instrumentation.instrumented("process_and_classify")
+def process_and_classify(
+    df: pd.DataFrame,
+    max_workers: int = PROCESS_MAX_WORKERS,
+    min_pool_rows: int = PROCESS_POOL_MIN_ROWS,
+    partition_key: str = PROCESS_PARTITION_KEY,
+    prefix_dict: dict = NCM_IDS_PREFIX_DICT,
+    class_keys: tuple = (),
+) -> pd.DataFrame:
+    """
+    process_defensivos_agricolas_df then create_one_hot_classification.
+
+    Frames of at least min_pool_rows are split per partition_key and
+    processed by a pool of max_workers processes. Partitions are sent to the
+    workers, and back, as Arrow IPC buffers.
+    """
+    if max_workers is None or max_workers <= 1 or len(df) < min_pool_rows:
+        return create_one_hot_classification(
+            process_defensivos_agricolas_df(df),
+            prefix_dict=prefix_dict,
+            class_keys=class_keys,
+        )
+
+    buffers = [
+        table_to_ipc(pa.Table.from_pandas(partition, preserve_index=False))
+        for _, partition in df.groupby(partition_key, observed=True, sort=True)
+    ]
+    # spawn: forking a process running threads (streamlit, fetch) is unsafe
+    with ProcessPoolExecutor(
+        max_workers=min(max_workers, len(buffers)),
+        mp_context=multiprocessing.get_context("spawn"),
+    ) as pool:
+        frames = [
+            ipc_to_frame(buffer)
+            for buffer in pool.map(
+                partial(_process_ipc, prefix_dict=prefix_dict, class_keys=class_keys),
+                buffers,
+            )
+        ]
+
+    df_processed = concat_categorical_frames(frames)
+    df_processed.attrs = {**df.attrs, "extracted_at": datetime.today().isoformat()}
+    return df_processed
+
+
+def _process_ipc(buffer: pa.Buffer, prefix_dict: dict, class_keys: tuple) -> pa.Buffer:
+    # process pool worker
+    df = create_one_hot_classification(
+        process_defensivos_agricolas_df(ipc_to_frame(buffer)),
+        prefix_dict=prefix_dict,
+        class_keys=class_keys,
     )
-    interest_ncm_ids_list = list(id_to_classification_map.keys())
+    return table_to_ipc(pa.Table.from_pandas(df, preserve_index=False))
 
-    response = query_defensivos_agricolas_from_comexstat(
-        ncm_produt_ids=interest_ncm_ids_list,
-        metrics_columns=POSSIBLE_METRICS,
-        start_year=1997,
-        end_year=2024,
+
+def table_to_ipc(table: pa.Table) -> pa.Buffer:
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue()
+
+
+def ipc_to_frame(buffer: pa.Buffer) -> pd.DataFrame:
+    return pa.ipc.open_stream(buffer).read_all().to_pandas()
+
+
+def create_denfensivos_agricolas_df(
+    consequence_level: str = DATA_QUALITY_CHECK_CONSEQUENCE,
+    partitioned_fetch: bool = True,
+    store: PartitionedStore = None,
+    quality_sample_size: int = DATA_QUALITY_SAMPLE_SIZE,
+) -> pd.DataFrame:
+    """
+    Fetch, check, process and classify the pesticide import records.
+    """
+    return create_dataset_df(
+        PESTICIDES_DATASET,
+        consequence_level=consequence_level,
+        partitioned_fetch=partitioned_fetch,
+        store=store,
+        quality_sample_size=quality_sample_size,
     )
 
-    df_response = pd.DataFrame.from_dict(response["data"]["list"]).rename(
-        columns=COLUMN_RENAME_MAP
+
+@instrumentation.instrumented("load_records")
+def create_dataset_df(
+    spec: DatasetSpec,
+    consequence_level: str = DATA_QUALITY_CHECK_CONSEQUENCE,
+    partitioned_fetch: bool = True,
+    store: PartitionedStore = None,
+    quality_sample_size: int = DATA_QUALITY_SAMPLE_SIZE,
+) -> pd.DataFrame:
+    """
+    Fetch, check, process and classify the import records of a spec.
+
+    With a store (see dataset_store), records are read from it and only
+    missing or still revisable months are requested from the API, for whole
+    NCM prefixes and every metric so other specs can reuse them. Data
+    quality is then taken from the checks done when each month was stored.
+    """
+    validate_dataset_spec(spec)
+    catalog = get_comexstat_filter_possible_values(filter_name="ncm")
+    interest_ncm_ids_list = dataset_ncm_ids(spec, catalog=catalog)
+
+    if store is not None:
+        sync_dataset_store(store, spec, catalog=catalog)
+        prefixes = list(group_ids_by_prefix(interest_ncm_ids_list))
+        table = store.read(prefixes, start_year=spec.start_year, end_year=spec.end_year)
+        quality_report = dataset_quality_report(store, spec, interest_ncm_ids_list)
+    elif partitioned_fetch:
+        table = query_defensivos_agricolas_partitioned(
+            ncm_produt_ids=interest_ncm_ids_list,
+            metrics_columns=list(spec.metrics),
+            start_year=spec.start_year,
+            end_year=spec.end_year,
+            detail_columns=spec.detail_columns,
+        )
+    else:
+        table = query_comexstat_table(
+            ComexstatQuery.create(
+                interest_ncm_ids_list,
+                spec.metrics,
+                start_year=spec.start_year,
+                end_year=spec.end_year,
+                detail_columns=spec.detail_columns,
+            )
+        )
+
+    table = select_dataset_records(table, spec, interest_ncm_ids_list)
+    df_raw = table.to_pandas().rename(columns=COLUMN_RENAME_MAP)
+    df_response = apply_compact_schema(df_raw)
+    LOGGER.debug(
+        "Compact schema: %.1f MB of arrow records -> %.1f MB",
+        table.nbytes / 1e6,
+        memory_usage_mb(df_response),
     )
+    del df_raw
 
-    check_data_quality(df_response, consequence_level=consequence_level)
+    if store is not None:
+        handle_data_quality_report(quality_report, consequence_level=consequence_level)
+    else:
+        check_data_quality(
+            df_response,
+            consequence_level=consequence_level,
+            sample_size=quality_sample_size,
+        )
 
-    df_processed = process_defensivos_agricolas_df(df_response)  # process
-    df_classified = create_one_hot_classification(df_processed)  # enriches
+    # process and enrich, per year on several cores for large frames
+    df_classified = process_and_classify(
+        df_response, prefix_dict=spec.prefix_dict, class_keys=spec.class_keys
+    )
+    df_classified.attrs["data_version"] = (
+        dataset_version(store, spec, interest_ncm_ids_list) if store else None
+    )
 
     return df_classified
 
 
+def get_data_version(df: pd.DataFrame) -> str:
+    """
+    Small token identifying the content of the frame, to key derived caches
+    on: the version of the store it was read from, else a hash of its rows
+    (computed once, then kept in `df.attrs`).
+    """
+    if df.attrs.get("data_version") is None:
+        df.attrs["data_version"] = hash_records(df)
+    return df.attrs["data_version"]
+
+
+@instrumentation.instrumented("melt")
 def melt_and_group_by_classes_and_dt(
     df: pd.DataFrame,
     value_keys: list = ANALYSIS_VALUE_KEYS,
     dt_key: str = ANALYSIS_DT_KEY,
+    class_keys: list = ANALYSIS_CLASS_KEYS,
 ):
-    _df = df.copy()
-
     dt_keys = [dt_key]
-    one_hot_keys = [
-        "is_domissanitario",
-        "is_herbicide",
-        "is_inseticide",
-        "is_fungicide",
-    ]
+    one_hot_keys = list(class_keys)
     _df_keys = value_keys + dt_keys + one_hot_keys
 
     # group
-    class_sums_df = _df[_df_keys].groupby(dt_keys + one_hot_keys).sum().reset_index()
+    class_sums_df = df[_df_keys].groupby(dt_keys + one_hot_keys).sum().reset_index()
     # melt
     melted_agg_df = class_sums_df.melt(
         id_vars=dt_keys + value_keys,
@@ -418,7 +1470,106 @@ def melt_and_group_by_classes_and_dt(
     # in the original data.
     melted_agg_df = melted_agg_df.drop(columns=["is_present"])
 
-    return melted_agg_df
+    return sort_by_dt(melted_agg_df, dt_key=dt_key)
+
+
+@instrumentation.instrumented("aggregates_update")
+def update_dataset_aggregates(
+    store: PartitionedStore,
+    spec: DatasetSpec,
+    ncm_ids: list,
+    dt_key: str = ANALYSIS_DT_KEY,
+) -> tuple:
+    """
+    Processed records (sorted by dt) and rollup cube frame of the stored
+    records of a spec, kept up to date incrementally: only the months added,
+    revised or removed since the last update are read, processed and
+    aggregated again, then merged into the saved aggregates.
+    """
+    prefixes = list(group_ids_by_prefix(ncm_ids))
+    month_hashes = store.month_hashes(prefixes, spec.start_year, spec.end_year)
+    definition = {
+        "pipeline": PIPELINE_VERSION,
+        "spec": spec._asdict(),
+        "ncm_ids": sorted(ncm_ids),
+    }
+
+    records_path = store.aggregate_path(f"{RECORDS_DERIVED_NAME}-{spec.name}")
+    records = IncrementalAggregate.load(records_path, dt_key, definition)
+    if records.month_hashes != month_hashes:
+        changed_months = records.changed_months(month_hashes)
+        table = select_dataset_records(
+            store.read_months(prefixes, records.stale_months(month_hashes)),
+            spec,
+            ncm_ids,
+        )
+        if table.num_rows > 0:
+            df = apply_compact_schema(
+                table.to_pandas().rename(columns=COLUMN_RENAME_MAP)
+            )
+            delta = process_and_classify(
+                df, prefix_dict=spec.prefix_dict, class_keys=spec.class_keys
+            )
+        else:  # only emptied or removed months
+            delta = records.table.iloc[:0]
+        records = records.merge(delta, month_hashes)
+        records.save(records_path, months=changed_months)
+
+    cube_path = store.aggregate_path(f"{ROLLUP_CUBE_DERIVED_NAME}-{spec.name}")
+    cube = IncrementalAggregate.load(
+        cube_path,
+        dt_key,
+        {**definition, "dimensions": ROLLUP_DIMENSIONS},
+    )
+    if cube.month_hashes != month_hashes:
+        changed_months = cube.changed_months(month_hashes)
+        # from the merged records: no month is processed twice
+        stale_records = records.table[
+            records.month_rows(cube.stale_months(month_hashes))
+        ]
+        delta = (
+            create_rollup_cube(
+                stale_records,
+                value_keys=dataset_value_keys(spec),
+                dt_key=dt_key,
+                class_keys=spec.class_keys,
+            ).cube
+            if len(stale_records)
+            else cube.table.iloc[:0]
+        )
+        cube = cube.merge(delta, month_hashes)
+        cube.save(cube_path, months=changed_months)
+
+    return records.table, cube.table
+
+
+def sort_by_dt(df: pd.DataFrame, dt_key: str = ANALYSIS_DT_KEY) -> pd.DataFrame:
+    return df.sort_values(dt_key, kind="stable", ignore_index=True)
+
+
+@instrumentation.instrumented("rollup_cube")
+def create_rollup_cube(
+    df: pd.DataFrame,
+    value_keys: list = ANALYSIS_VALUE_KEYS,
+    dt_key: str = ANALYSIS_DT_KEY,
+    dimensions: list = ROLLUP_DIMENSIONS,
+    class_keys: tuple = tuple(ANALYSIS_CLASS_KEYS),
+) -> RollupCube:
+    """
+    Pre-aggregate the records per month, class, country, state and transport
+    so the dashboard answers date range queries without the row level data.
+    Value keys and dimensions the dataset lacks are skipped. Without records
+    (the frame may then have no columns at all) every value key is kept.
+    """
+    if len(df):
+        value_keys = [value_key for value_key in value_keys if value_key in df]
+    return RollupCube.from_frame(
+        df,
+        dt_key=dt_key,
+        class_keys=list(class_keys),
+        dimensions=[dimension for dimension in dimensions if dimension in df],
+        value_keys=value_keys,
+    )
 
 
 def seasonal_decompose_pesticide_import_data(
@@ -426,11 +1577,208 @@ def seasonal_decompose_pesticide_import_data(
     value_keys: list = ANALYSIS_VALUE_KEYS,
     dt_key: str = ANALYSIS_DT_KEY,
 ):
-    _df = df.copy()
+    """
+    Decompose the monthly totals of every value key. Components are frames
+    with one column per value key.
+    """
     monthly_ts_df = (
-        _df[[dt_key] + value_keys].resample("ME", on=dt_key).sum()
+        df[[dt_key] + value_keys].resample("ME", on=dt_key).sum()
     )  # ts = timeseries
-    return seasonal_decompose(monthly_ts_df)
+    return seasonal_decompose_columns(monthly_ts_df)
+
+
+def seasonal_decompose_columns(monthly_ts_df: pd.DataFrame) -> "DecomposeResult":
+    """
+    Decompose every column of a monthly frame in a single batched pass.
+    """
+    from statsmodels.tsa.seasonal import DecomposeResult, seasonal_decompose
+
+    result = seasonal_decompose(
+        monthly_ts_df.to_numpy(dtype=float), period=MONTHS_PER_YEAR
+    )
+
+    def to_frame(component):
+        return pd.DataFrame(
+            component, index=monthly_ts_df.index, columns=monthly_ts_df.columns
+        )
+
+    return DecomposeResult(
+        observed=monthly_ts_df,
+        seasonal=to_frame(result.seasonal),
+        trend=to_frame(result.trend),
+        resid=to_frame(result.resid),
+        weights=to_frame(result.weights),
+    )
+
+
+def build_seasonal_series_matrix(
+    rollup_cube: RollupCube,
+    value_keys: list = None,
+    country_key: str = SEASONAL_COUNTRY_KEY,
+    top_countries: int = SEASONAL_TOP_COUNTRIES,
+) -> pd.DataFrame:
+    """
+    Dense month x (value_key, series) matrix of the total, every product class
+    and the top countries of each value key (every value key of the cube by
+    default).
+    """
+    columns = {}
+    for value_key in value_keys or rollup_cube.value_keys:
+        columns[(value_key, TOTAL_SERIES)] = rollup_cube.monthly_total(value_key)
+
+        by_class = rollup_cube.monthly_matrix(CLASS_DIMENSION, value_key)
+        for class_key in by_class.columns:
+            columns[(value_key, series_id(CLASS_DIMENSION, class_key))] = by_class[
+                class_key
+            ]
+
+        if country_key not in rollup_cube.cumulative_sums:
+            continue
+        by_country = rollup_cube.monthly_matrix(country_key, value_key)
+        for country in by_country.sum().nlargest(top_countries).index:
+            columns[(value_key, series_id("country", country))] = by_country[country]
+
+    return pd.DataFrame(columns).rename_axis(columns=["value_key", "series"])
+
+
+@instrumentation.instrumented("decomposition")
+def create_seasonal_decompositions(
+    rollup_cube: RollupCube,
+    store: PartitionedStore = None,
+    name: str = SEASONAL_DERIVED_NAME,
+    version: str = None,
+) -> SeriesDecompositions:
+    """
+    Decompose every series of build_seasonal_series_matrix at once.
+
+    With a store, the results are saved as `name` next to the version of the
+    records they come from (the store version by default), and read back
+    while that version is current.
+    """
+    path = None
+    if store is not None and (version or store.version) is not None:
+        path = store.derived_path(name, version=version)
+        if path.exists():
+            return SeriesDecompositions.load(path)
+
+    decompositions = SeriesDecompositions.from_monthly(
+        build_seasonal_series_matrix(rollup_cube), period=MONTHS_PER_YEAR
+    )
+    if path is not None:
+        decompositions.save(path)
+        store.prune_derived(name, version=version)
+    return decompositions
+
+
+class Snapshot(NamedTuple):
+    """
+    Everything the dashboard reads: the processed records, sorted by date,
+    and their derived aggregates.
+    """
+
+    data: pd.DataFrame
+    rollup_cube: RollupCube
+    seasonal_decompositions: SeriesDecompositions
+    version: str
+
+
+@instrumentation.instrumented("build_snapshot")
+def build_snapshot(
+    store: PartitionedStore = None, spec: DatasetSpec = PESTICIDES_DATASET
+) -> Snapshot:
+    """
+    Fetch (through the store, when given), process and aggregate the records
+    of a spec. With a store, only the months changed since the previous build
+    are processed and aggregated (see update_dataset_aggregates).
+    """
+    if store is None:
+        data = sort_by_dt(create_dataset_df(spec))
+        version = get_data_version(data)
+        rollup_cube = create_rollup_cube(
+            data, value_keys=dataset_value_keys(spec), class_keys=spec.class_keys
+        )
+    else:
+        ncm_ids = sync_dataset_store(store, spec)
+        handle_data_quality_report(dataset_quality_report(store, spec, ncm_ids))
+        data, cube = update_dataset_aggregates(store, spec, ncm_ids)
+        version = dataset_version(store, spec, ncm_ids)
+        data.attrs["data_version"] = version
+        # the cumulative sums are rebuilt from the merged cube, as on load
+        rollup_cube = create_rollup_cube(
+            cube, value_keys=dataset_value_keys(spec), class_keys=spec.class_keys
+        )
+    return Snapshot(
+        data=data,
+        rollup_cube=rollup_cube,
+        seasonal_decompositions=create_seasonal_decompositions(
+            rollup_cube,
+            store=store,
+            name=f"{SEASONAL_DERIVED_NAME}-{spec.name}",
+            version=version,
+        ),
+        version=version,
+    )
+
+
+@instrumentation.instrumented("save_snapshot")
+def save_snapshot(snapshot: Snapshot, snapshot_store: SnapshotStore) -> str:
+    """
+    Write the snapshot under its version and make it the current one,
+    returning the name it was written as (see SnapshotStore.write).
+    """
+    name = snapshot_store.write(
+        snapshot.version,
+        frames={
+            "data": snapshot.data,
+            "rollup_cube": snapshot.rollup_cube.cube,
+            "seasonal_decompositions": snapshot.seasonal_decompositions.components,
+        },
+        metadata={"rows": len(snapshot.data)},
+    )
+    snapshot_store.publish(name)
+    return name
+
+
+@instrumentation.instrumented("load_snapshot")
+def load_snapshot(
+    snapshot_store: SnapshotStore,
+    version: str,
+    with_data: bool = True,
+    spec: DatasetSpec = PESTICIDES_DATASET,
+) -> Snapshot:
+    """
+    Read a written snapshot. The cumulative sums of the rollup cube are
+    rebuilt, the cube itself is already aggregated.
+
+    Without data, the records are left on disk (data is None), to be queried
+    through snapshot_query_backend.
+    """
+    data = snapshot_store.read_frame(version, "data") if with_data else None
+    return Snapshot(
+        data=data,
+        rollup_cube=create_rollup_cube(
+            snapshot_store.read_frame(version, "rollup_cube"),
+            value_keys=dataset_value_keys(spec),
+            class_keys=spec.class_keys,
+        ),
+        seasonal_decompositions=SeriesDecompositions(
+            snapshot_store.read_frame(version, "seasonal_decompositions")
+        ),
+        version=version,
+    )
+
+
+def snapshot_query_backend(
+    snapshot_store: SnapshotStore, version: str, engine: str = None
+) -> QueryBackend:
+    """
+    Out of core queries over the records of a written snapshot.
+    """
+    return create_query_backend(
+        snapshot_store.frame_path(version, "data"),
+        dt_key=ANALYSIS_DT_KEY,
+        engine=engine,
+    )
 
 
 # # TODO create constant for URL, pass as parameter
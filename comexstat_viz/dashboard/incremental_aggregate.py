@@ -0,0 +1,151 @@
+import json
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+from pandas.api.types import union_categoricals
+from pathlib import Path
+
+
+def concat_categorical_frames(frames: list) -> pd.DataFrame:
+    """
+    Concatenate frames, keeping as categoricals the columns whose categories
+    differ between frames (pd.concat falls back to object for those).
+    """
+    df = pd.concat(frames, ignore_index=True)
+    for column in frames[0].columns:
+        if isinstance(frames[0][column].dtype, pd.CategoricalDtype) and not (
+            isinstance(df[column].dtype, pd.CategoricalDtype)
+        ):
+            df[column] = union_categoricals([frame[column] for frame in frames])
+    return df
+
+
+class IncrementalAggregate:
+    """
+    Aggregate of monthly groups, kept across data versions. Every month
+    remembers the hash of the records it was computed from, so an update only
+    recomputes the months added, revised or removed since, and keeps the
+    others as they are.
+
+    Rows must not mix months: each month is replaced as a whole.
+    """
+
+    def __init__(
+        self, table: pd.DataFrame, month_hashes: dict, dt_key: str, definition: dict
+    ):
+        self.table = table
+        # {"YYYY-MM": hash of the records of the month}
+        self.month_hashes = month_hashes
+        self.dt_key = dt_key
+        # what the aggregate is computed with (value keys, classes...): a
+        # saved aggregate with another definition is recomputed from scratch
+        self.definition = definition
+
+    def stale_months(self, month_hashes: dict) -> list:
+        """
+        Months of month_hashes the aggregate lacks or computed from other
+        records, as "YYYY-MM" keys.
+        """
+        return sorted(
+            month
+            for month, month_hash in month_hashes.items()
+            if self.month_hashes.get(month) != month_hash
+        )
+
+    def changed_months(self, month_hashes: dict) -> list:
+        """
+        Stale months of month_hashes plus the months it no longer has: every
+        month whose rows a merge replaces or drops.
+        """
+        removed = set(self.month_hashes) - set(month_hashes)
+        return sorted(set(self.stale_months(month_hashes)) | removed)
+
+    def month_rows(self, months: list) -> pd.Series:
+        """
+        Mask of the rows of the given "YYYY-MM" months. Rows are matched on
+        their month start date, without formatting the dates of every row.
+        """
+        return self.table[self.dt_key].isin(month_start_index(months))
+
+    def merge(self, delta: pd.DataFrame, month_hashes: dict) -> "IncrementalAggregate":
+        """
+        Aggregate of month_hashes: delta holds the rows of its stale months,
+        months missing from month_hashes are dropped.
+        """
+        kept = self.table[~self.month_rows(self.changed_months(month_hashes))]
+        table = concat_categorical_frames([kept, delta]) if len(kept) else delta
+        return IncrementalAggregate(
+            # stable: the rows of a month keep the order they were computed in
+            table.sort_values(self.dt_key, kind="stable", ignore_index=True),
+            dict(month_hashes),
+            self.dt_key,
+            self.definition,
+        )
+
+    def save(self, path, months: list = None):
+        """
+        Write the aggregate as one parquet file per year under the path
+        directory. With months, only the files of their years are rewritten
+        (see changed_months): the others still hold the same rows.
+        """
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        if months is None:
+            months = self.month_hashes
+        years = {int(month[:4]) for month in months}
+        dts = self.table[self.dt_key]
+        for year in sorted(years):
+            start, end = dts.searchsorted(
+                [pd.Timestamp(year, 1, 1), pd.Timestamp(year + 1, 1, 1)]
+            )
+            year_path = path / year_file_name(year)
+            if end > start:
+                self.table.iloc[start:end].to_parquet(year_path, index=False)
+            else:
+                year_path.unlink(missing_ok=True)
+        with open(path.with_suffix(".json"), "w") as f:
+            json.dump(
+                {"definition": self.definition, "month_hashes": self.month_hashes},
+                f,
+                indent=1,
+                sort_keys=True,
+            )
+
+    @classmethod
+    def load(cls, path, dt_key: str, definition: dict) -> "IncrementalAggregate":
+        """
+        Saved aggregate, or an empty one when there is none for definition.
+        """
+        path = Path(path)
+        empty = cls(pd.DataFrame({dt_key: pd.to_datetime([])}), {}, dt_key, definition)
+        if not path.is_dir() or not path.with_suffix(".json").exists():
+            return empty
+        with open(path.with_suffix(".json")) as f:
+            saved = json.load(f)
+        # compared as saved: json turns tuples into lists
+        if saved["definition"] != json.loads(json.dumps(definition)):
+            return empty
+        # the years of the saved months only: files of other years are left
+        # over from previous definitions
+        files = [
+            str(path / year_file_name(year))
+            for year in sorted({int(month[:4]) for month in saved["month_hashes"]})
+            if (path / year_file_name(year)).exists()
+        ]
+        if not files:
+            return cls(empty.table, saved["month_hashes"], dt_key, definition)
+        # read as one table: arrow unifies the categories of the files
+        table = pq.read_table(files, partitioning=None).to_pandas()
+        return cls(table, saved["month_hashes"], dt_key, definition)
+
+
+def year_file_name(year: int) -> str:
+    return f"year={year}.parquet"
+
+
+def month_start_index(months: list) -> pd.DatetimeIndex:
+    """
+    First day of every "YYYY-MM" month.
+    """
+    return pd.DatetimeIndex(pd.to_datetime(list(months), format="%Y-%m"))
@@ -0,0 +1,228 @@
+"""
+Lightweight stage instrumentation: wall time, rows, bytes, the change of the
+resident memory and the process peak memory of every stage, emitted as one
+json log line per stage on the "comexstat_viz.stages" logger and collected
+per rerun for the diagnostics panel (see start_collecting).
+
+    with instrumentation.stage("fetch.stream") as record:
+        ...
+        record["rows"] = table.num_rows
+
+    @instrumentation.instrumented("process")  # rows / bytes of the result
+    def process(df): ...
+"""
+
+import functools
+import importlib.util
+import io
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+from contextlib import contextmanager
+
+LOGGER = logging.getLogger("comexstat_viz.stages")
+# COMEXSTAT_LOG_LEVEL=WARNING silences the stage logs
+LOG_LEVEL = os.environ.get("COMEXSTAT_LOG_LEVEL", "INFO")
+PROFILE_REPORT_LINES = 40
+
+_local = threading.local()
+
+
+def configure_logging(level: str = LOG_LEVEL):
+    """
+    Write the stage logs to stderr. Idempotent, so it can run on every
+    streamlit rerun.
+    """
+    logger = logging.getLogger("comexstat_viz")
+    logger.setLevel(level)
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        logger.addHandler(handler)
+
+
+def rss_mb():
+    """
+    Current resident memory of the process, None where unavailable (read
+    from /proc, so Linux only).
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            resident_pages = int(f.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return round(resident_pages * os.sysconf("SC_PAGE_SIZE") / 1e6, 1)
+
+
+def peak_rss_mb():
+    """
+    High water mark of the process resident memory, None where unavailable.
+    It never goes down: a stage only raises it by peaking above every stage
+    before it.
+    """
+    try:
+        import resource
+    except ImportError:  # windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return round(peak / 1e6 if sys.platform == "darwin" else peak / 1e3, 1)
+
+
+def result_size(result) -> dict:
+    """
+    Rows and (shallow) bytes of a frame, series, arrow table or buffer.
+    """
+    if hasattr(result, "num_rows"):  # arrow
+        return {"rows": result.num_rows, "bytes": result.nbytes}
+    if hasattr(result, "memory_usage"):  # pandas, without walking the objects
+        return {"rows": len(result), "bytes": int(result.memory_usage().sum())}
+    if isinstance(result, (bytes, str)):
+        return {"bytes": len(result)}
+    return {}
+
+
+def _stack() -> list:
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+        _local.collectors = []
+    return _local.stack
+
+
+@contextmanager
+def stage(name: str, **fields):
+    """
+    Time the enclosed block. The yielded record can be filled with counters
+    (rows, bytes...), logged with the timing when the block exits.
+    """
+    stack = _stack()
+    record = {"stage": name, "parent": stack[-1]["stage"] if stack else None}
+    record.update(fields)
+    stack.append(record)
+    start_rss = rss_mb()
+    start = time.perf_counter()
+    try:
+        yield record
+    except Exception as e:
+        record["error"] = type(e).__name__
+        raise
+    finally:
+        stack.pop()
+        record["seconds"] = round(time.perf_counter() - start, 6)
+        end_rss = rss_mb()
+        # process wide: includes what other threads allocated meanwhile
+        record["rss_delta_mb"] = (
+            round(end_rss - start_rss, 1) if None not in (start_rss, end_rss) else None
+        )
+        record["process_peak_rss_mb"] = peak_rss_mb()
+        _emit(record)
+
+
+def instrumented(name: str = None):
+    """
+    Decorator running the function as a stage, with the rows and bytes of
+    its result.
+    """
+
+    def decorator(function):
+        stage_name = name or function.__name__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(stage_name) as record:
+                result = function(*args, **kwargs)
+                record.update(result_size(result))
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def _emit(record: dict):
+    for collected in _local.collectors:
+        collected.append(record)
+    LOGGER.info(json.dumps(record, default=str))
+
+
+def start_collecting() -> list:
+    """
+    Collect, into the returned list, the records of the stages this thread
+    runs until stop_collecting, e.g. during a streamlit rerun. Stages run on
+    other threads (the fetch pool) are only logged.
+    """
+    _stack()
+    collected = []
+    _local.collectors.append(collected)
+    return collected
+
+
+def stop_collecting(collected: list):
+    _stack()
+    if collected in _local.collectors:
+        _local.collectors.remove(collected)
+
+
+class CountingReader:
+    """
+    File-like wrapper counting the bytes read and the seconds spent waiting
+    for them, e.g. on a streamed http response.
+    """
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.bytes_read = 0
+        self.read_seconds = 0.0
+
+    def read(self, size: int = -1) -> bytes:
+        start = time.perf_counter()
+        data = self.raw.read(size)
+        self.read_seconds += time.perf_counter() - start
+        self.bytes_read += len(data)
+        return data
+
+
+class Profiler:
+    """
+    Opt-in profile of a block of code, e.g. a single streamlit rerun:
+    pyinstrument when installed, else cProfile.
+    """
+
+    def __init__(self, lines: int = PROFILE_REPORT_LINES):
+        self.lines = lines
+        self.name = (
+            "pyinstrument" if importlib.util.find_spec("pyinstrument") else "cProfile"
+        )
+        self._profiler = None
+
+    def start(self):
+        if self.name == "pyinstrument":
+            from pyinstrument import Profiler as PyinstrumentProfiler
+
+            self._profiler = PyinstrumentProfiler()
+            self._profiler.start()
+        else:
+            import cProfile
+
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+
+    def stop(self) -> str:
+        """
+        Stop profiling, returning the text report.
+        """
+        if self.name == "pyinstrument":
+            self._profiler.stop()
+            return self._profiler.output_text()
+
+        import pstats
+
+        self._profiler.disable()
+        report = io.StringIO()
+        stats = pstats.Stats(self._profiler, stream=report).sort_stats("cumulative")
+        stats.print_stats(self.lines)
+        return report.getvalue()
@@ -0,0 +1,82 @@
+"""
+Peak memory check of the load pipeline.
+
+Runs fetch_data.create_denfensivos_agricolas_df against the offline mock
+COMEXSTAT server and compares its peak memory (Python and numpy allocations
+traced by tracemalloc, plus the peak of the Arrow memory pool) to the size of
+the raw records it loads, as an Arrow table. Exits 1 when the peak is over a
+fixed multiple of that size.
+
+    python memory_profile.py
+    python memory_profile.py --scale 5 --max-ratio 3.5
+"""
+
+import argparse
+import os
+import tracemalloc
+import warnings
+
+import pyarrow as pa
+
+from mock_comexstat import start_mock_server
+
+DEFAULT_SCALE = 1
+# peak memory of the load / bytes of the raw records
+MAX_PEAK_RATIO = 4.0  # about 3x at scale 1 and 5
+# fixed, the mock NCM catalog is cached on disk by url
+MOCK_PORT = 8766
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--scale", type=float, default=DEFAULT_SCALE)
+    parser.add_argument("--max-ratio", type=float, default=MAX_PEAK_RATIO)
+    parser.add_argument("--port", type=int, default=MOCK_PORT)
+    args = parser.parse_args()
+
+    server, mock, base_url = start_mock_server(port=args.port, scale=args.scale)
+    os.environ["COMEXSTAT_BASE_URL"] = base_url
+    import fetch_data as fd  # reads COMEXSTAT_BASE_URL on import
+
+    warnings.simplefilter("ignore")
+    fd.query_flights().ttl = 0  # every run fetches, no result is kept
+
+    pool = pa.default_memory_pool()
+    arrow_baseline = pool.bytes_allocated()
+    tracemalloc.start()
+    df = fd.create_denfensivos_agricolas_df()
+    traced_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    # the pool high water mark covers the whole process: an upper bound
+    peak = traced_peak + max(pool.max_memory() - arrow_baseline, 0)
+    del df
+
+    spec = fd.PESTICIDES_DATASET
+    ncm_ids = fd.dataset_ncm_ids(
+        spec, catalog=fd.get_comexstat_filter_possible_values(filter_name="ncm")
+    )
+    raw = fd.select_dataset_records(
+        fd.query_defensivos_agricolas_partitioned(
+            ncm_produt_ids=ncm_ids,
+            metrics_columns=list(spec.metrics),
+            start_year=spec.start_year,
+            end_year=spec.end_year,
+        ),
+        spec,
+        ncm_ids,
+    )
+    server.shutdown()
+
+    ratio = peak / raw.nbytes
+    print(
+        f"{raw.num_rows} rows, raw records {raw.nbytes / 1e6:.1f} MB, "
+        f"load peak {peak / 1e6:.1f} MB "
+        f"(traced {traced_peak / 1e6:.1f} MB), {ratio:.1f}x"
+    )
+    if ratio > args.max_ratio:
+        print(f"OVER BUDGET load peak {ratio:.1f}x > {args.max_ratio}x the raw records")
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+"""
+Offline stand-in for the COMEXSTAT API.
+
+Serves `/general` and `/general/filters/ncm` with synthetic records (or
+records replayed from a recorded `/general` response) at a configurable size
+and latency.
+
+    python mock_comexstat.py --port 8765 --scale 10 --latency 0.2
+    COMEXSTAT_BASE_URL=http://127.0.0.1:8765/general streamlit run app.py
+"""
+
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# on average, rows per (month, NCM id) at scale 1. Close to the ~52k rows of
+# the real 1997-2024 pesticide history
+BASE_ROWS_PER_PRODUCT_MONTH = 1.4
+
+NCM_PREFIX_DESCRIPTIONS = {
+    "38081": ["inseticidas", "inseticidas domissanitários"],
+    "38082": ["fungicidas", "fungicidas e inseticidas"],
+    "38083": ["herbicidas", "inibidores de germinação"],
+    "38084": ["desinfetantes", "desinfetantes domissanitários"],
+    "38085": ["produtos mencionados na nota de subposições"],
+    "38089": ["outros", "outros inseticidas e fungicidas"],
+    "29039": ["ddt (clofenotano)"],
+    "01012": ["cavalos reprodutores"],  # not a pesticide, filtered out by prefix
+}
+NCM_IDS_PER_PREFIX = 16
+
+COUNTRIES = [
+    "Alemanha",
+    "Argentina",
+    "Brasil",
+    "China",
+    "Espanha",
+    "Estados Unidos",
+    "França",
+    "Índia",
+    "Israel",
+    "Japão",
+    "Paraguai",
+    "Reino Unido",
+    "Suíça",
+    "Uruguai",
+]
+STATES = ["São Paulo", "Paraná", "Goiás", "Mato Grosso", "Rio Grande do Sul"]
+TRANSPORT_METHODS = ["MARITIMA", "AEREA", "RODOVIARIA", "FERROVIARIA"]
+FEDERAL_AGENCIES = ["Porto de Santos", "Porto de Paranaguá", "Aeroporto de Viracopos"]
+
+
+def build_ncm_catalog() -> list:
+    catalog = []
+    for prefix, descriptions in NCM_PREFIX_DESCRIPTIONS.items():
+        for i in range(NCM_IDS_PER_PREFIX):
+            ncm_id = f"{prefix}{i:03d}"
+            description = descriptions[i % len(descriptions)]
+            catalog.append(
+                {"id": ncm_id, "text": f"{ncm_id} - {description.capitalize()}"}
+            )
+    return catalog
+
+
+def synthetic_records(
+    ncm_id: str, text: str, year: int, month: int, scale: float
+) -> list:
+    """
+    Deterministic records of one NCM id and month, without duplicate keys.
+    """
+    rnd = random.Random(f"{ncm_id}-{year}-{month}")
+    n_rows = rnd.randint(0, round(2 * BASE_ROWS_PER_PRODUCT_MONTH * scale))
+
+    dimensions = [COUNTRIES, STATES, TRANSPORT_METHODS, FEDERAL_AGENCIES]
+    space = 1
+    for values in dimensions:
+        space *= len(values)
+
+    records = []
+    for combination in rnd.sample(range(space), min(n_rows, space)):
+        keys = []
+        for values in dimensions:
+            combination, i = divmod(combination, len(values))
+            keys.append(values[i])
+        kg = rnd.randint(1, 500_000)
+        fob = kg * rnd.uniform(2, 20)
+        freight, insurance = fob * 0.05, fob * 0.005
+        records.append(
+            {
+                "coAno": str(year),
+                "coMes": f"{month:02d}",
+                "noPaispt": keys[0],
+                "noUf": keys[1],
+                "noVia": keys[2],
+                "noUrf": keys[3],
+                "coNcm": ncm_id,
+                "noNcmpt": text,
+                "noUnid": "QUILOGRAMA LIQUIDO",
+                "vlFob": str(round(fob)),
+                "vlFrete": str(round(freight)),
+                "vlSeguro": str(round(insurance)),
+                "vlCif": str(round(fob + freight + insurance)),
+                "kgLiquido": str(kg),
+                "qtEstat": str(kg),
+            }
+        )
+    return records
+
+
+class MockComexstat:
+    """
+    Response factory shared by the request handlers. `scale` multiplies the
+    number of rows, `latency` (seconds) is slept before every response.
+    """
+
+    def __init__(
+        self, scale: float = 1, latency: float = 0, recorded_records: list = None
+    ):
+        self.scale = scale
+        self.latency = latency
+        self.recorded_records = recorded_records
+        self.catalog = build_ncm_catalog()
+        self.request_count = 0
+        self._lock = threading.Lock()
+
+    def filters_payload(self, filter_name: str) -> dict:
+        if filter_name != "ncm":
+            return {"data": [[]]}
+        return {"data": [self.catalog]}
+
+    def general_payload(self, filter_params: dict) -> dict:
+        ncm_ids = set(filter_params["filterArray"][0]["item"])
+        years = range(
+            int(filter_params["yearStart"]), int(filter_params["yearEnd"]) + 1
+        )
+        months = range(
+            int(filter_params.get("monthStart", 1)),
+            int(filter_params.get("monthEnd", 12)) + 1,
+        )
+
+        if self.recorded_records is not None:
+            records = [
+                record
+                for record in self.recorded_records
+                if record["coNcm"] in ncm_ids
+                and int(record["coAno"]) in years
+                and int(record["coMes"]) in months
+            ] * max(1, round(self.scale))
+        else:
+            records = [
+                record
+                for item in self.catalog
+                if item["id"] in ncm_ids
+                for year in years
+                for month in months
+                for record in synthetic_records(
+                    item["id"], item["text"], year, month, self.scale
+                )
+            ]
+        return {"success": True, "data": {"list": records}}
+
+
+def make_handler(mock: MockComexstat):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass  # quiet
+
+        def _send_json(self, payload: dict, extra_headers: dict = None):
+            body = json.dumps(payload).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            for name, value in (extra_headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            with mock._lock:
+                mock.request_count += 1
+            time.sleep(mock.latency)
+            url = urlparse(self.path)
+            parts = [part for part in url.path.split("/") if part]
+
+            if parts[:2] == ["general", "filters"] and len(parts) == 3:
+                payload = mock.filters_payload(parts[2])
+                etag = hashlib.sha1(json.dumps(payload).encode()).hexdigest()
+                if self.headers.get("If-None-Match") == etag:
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                self._send_json(payload, {"ETag": etag})
+
+            elif parts == ["general"]:
+                filter_params = json.loads(parse_qs(url.query)["filter"][0])
+                self._send_json(mock.general_payload(filter_params))
+
+            else:
+                self.send_error(404)
+
+    return Handler
+
+
+def start_mock_server(
+    port: int = 0, scale: float = 1, latency: float = 0, recorded_records: list = None
+) -> tuple:
+    """
+    Serve the mock API from a daemon thread. Returns (server, mock, base_url);
+    port 0 picks a free port.
+    """
+    mock = MockComexstat(
+        scale=scale, latency=latency, recorded_records=recorded_records
+    )
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(mock))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}/general"
+    return server, mock, base_url
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--scale", type=float, default=1)
+    parser.add_argument("--latency", type=float, default=0, help="seconds per request")
+    parser.add_argument(
+        "--recorded",
+        help="recorded /general json response to replay instead of synthetic data",
+    )
+    args = parser.parse_args()
+
+    recorded_records = None
+    if args.recorded:
+        with open(args.recorded) as f:
+            recorded_records = json.load(f)["data"]["list"]
+
+    server, _, base_url = start_mock_server(
+        args.port,
+        scale=args.scale,
+        latency=args.latency,
+        recorded_records=recorded_records,
+    )
+    print(f"Mock COMEXSTAT serving on {base_url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+# NCM codes are 8 digit strings organised hierarchically: the first 2 digits
+# are the chapter, 4 the heading, 6 the subheading, 7 the item and 8 the subitem
+
+NCM_LEVEL_LENGTHS = {
+    "chapter": 2,
+    "heading": 4,
+    "subheading": 6,
+    "item": 7,
+    "subitem": 8,
+}
+
+
+class _Node:
+    __slots__ = ("children", "label")
+
+    def __init__(self):
+        self.children = {}
+        self.label = None
+
+
+class NcmPrefixIndex:
+    """
+    Trie mapping NCM prefixes to labels.
+
+    Several prefixes may share a label. Lookups walk at most one node per digit
+    of the code, so classifying a whole catalog is linear in its size no matter
+    how many prefixes are indexed.
+    """
+
+    def __init__(self):
+        self._root = _Node()
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    @classmethod
+    def from_label_prefixes(cls, label_to_prefixes: dict) -> "NcmPrefixIndex":
+        """
+        Build from a {label: prefix or [prefixes]} dictionary.
+        """
+        index = cls()
+        for label, prefixes in label_to_prefixes.items():
+            if isinstance(prefixes, str):
+                prefixes = [prefixes]
+            for prefix in prefixes:
+                index.add(prefix, label)
+        return index
+
+    def add(self, prefix: str, label):
+        node = self._root
+        for digit in prefix:
+            node = node.children.setdefault(digit, _Node())
+        if node.label is None:
+            self._size += 1
+        node.label = label
+
+    def matches(self, code: str) -> list:
+        """
+        Every indexed (prefix, label) the code starts with, shortest first.
+        """
+        found = []
+        node = self._root
+        for depth, digit in enumerate(code, start=1):
+            node = node.children.get(digit)
+            if node is None:
+                break
+            if node.label is not None:
+                found.append((code[:depth], node.label))
+        return found
+
+    def longest_prefix_match(self, code: str, max_length: int = None):
+        """
+        (prefix, label) of the longest indexed prefix of the code, only
+        considering prefixes up to max_length digits. None if nothing matches.
+        """
+        found = [
+            match
+            for match in self.matches(code)
+            if max_length is None or len(match[0]) <= max_length
+        ]
+        return found[-1] if found else None
+
+    def get(self, code: str, default=None, level: str = None):
+        """
+        Label of the longest indexed prefix of the code. With a level
+        ("chapter", "heading", ...), only prefixes down to that level count.
+        """
+        max_length = NCM_LEVEL_LENGTHS[level] if level is not None else None
+        match = self.longest_prefix_match(code, max_length=max_length)
+        return match[1] if match is not None else default
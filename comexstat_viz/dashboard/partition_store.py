@@ -0,0 +1,282 @@
+import hashlib
+import json
+import os
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as pa_dataset
+
+from collections import defaultdict
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from data_quality import DataQualityReport
+
+DEFAULT_STORE_DIR = Path(__file__).resolve().parents[1] / "data" / "raw"
+MANIFEST_FILE_NAME = "manifest.json"
+PARTITION_FILE_NAME = "data.parquet"
+DERIVED_DIR_NAME = "derived"  # results computed from a version of the records
+# bump when the stored columns change, older stores are fetched again
+STORE_FORMAT_VERSION = 5
+
+# COMEXSTAT keeps revising the latest months. A month is only considered final
+# once it was fetched this long after it ended.
+REVISION_WINDOW_MONTHS = 3
+# do not re-fetch still revisable months more often than this
+REVISABLE_REFRESH_INTERVAL = timedelta(days=1)
+
+
+def month_end(year: int, month: int) -> datetime:
+    if month == 12:
+        return datetime(year + 1, 1, 1)
+    return datetime(year, month + 1, 1)
+
+
+def add_months(dt: datetime, months: int) -> datetime:
+    total = dt.year * 12 + dt.month - 1 + months
+    return dt.replace(year=total // 12, month=total % 12 + 1)
+
+
+def hash_query(ncm_ids: list, metrics_columns: list) -> str:
+    serialized = ",".join(sorted(ncm_ids)) + "|" + ",".join(sorted(metrics_columns))
+    return hashlib.sha1(serialized.encode()).hexdigest()[:12]
+
+
+def hash_records(df: pd.DataFrame) -> str:
+    if df.empty:
+        return "empty"
+    return str(pd.util.hash_pandas_object(df, index=False).sum())
+
+
+class PartitionedStore:
+    """
+    Parquet store of raw COMEXSTAT records, partitioned by NCM prefix, year and
+    month, with a json manifest of what was fetched and when.
+
+    Layout: <root>/prefix=<prefix>/year=<year>/month=<month>/data.parquet
+    """
+
+    def __init__(self, root=DEFAULT_STORE_DIR):
+        self.root = Path(root)
+        self.manifest_path = self.root / MANIFEST_FILE_NAME
+        self.manifest = self._load_manifest()
+
+    def _load_manifest(self) -> dict:
+        empty_manifest = {
+            "format_version": STORE_FORMAT_VERSION,
+            "version": None,
+            "partitions": {},
+        }
+        if not self.manifest_path.exists():
+            return empty_manifest
+        with open(self.manifest_path) as f:
+            manifest = json.load(f)
+
+        if manifest.get("format_version") != STORE_FORMAT_VERSION:
+            return empty_manifest
+        return manifest
+
+    def save_manifest(self):
+        self.manifest["version"] = self._compute_version()
+        self.root.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.manifest_path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self.manifest, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.manifest_path)  # atomic
+
+    def _compute_version(self) -> str:
+        content = {
+            key: entry["content_hash"]
+            for key, entry in self.manifest["partitions"].items()
+        }
+        serialized = json.dumps(content, sort_keys=True).encode()
+        return hashlib.sha1(serialized).hexdigest()[:12]
+
+    @property
+    def version(self):
+        return self.manifest["version"]
+
+    @staticmethod
+    def partition_key(prefix: str, year: int, month: int) -> str:
+        return f"{prefix}/{year}-{month:02d}"
+
+    def partition_path(self, prefix: str, year: int, month: int) -> Path:
+        return (
+            self.root
+            / f"prefix={prefix}"
+            / f"year={year}"
+            / f"month={month:02d}"
+            / PARTITION_FILE_NAME
+        )
+
+    def derived_path(self, name: str, version: str = None) -> Path:
+        """
+        Path of the `name` result derived from a version of the records, the
+        current one by default.
+        """
+        version = version or self.version
+        return self.root / DERIVED_DIR_NAME / f"{name}-{version}.parquet"
+
+    def aggregate_path(self, name: str) -> Path:
+        """
+        Directory of the `name` result updated in place from version to
+        version (see IncrementalAggregate.save).
+        """
+        return self.root / DERIVED_DIR_NAME / name
+
+    def prune_derived(self, name: str, version: str = None):
+        """
+        Remove the `name` results of every other version.
+        """
+        current_path = self.derived_path(name, version=version)
+        for path in (self.root / DERIVED_DIR_NAME).glob(f"{name}-*.parquet"):
+            if path != current_path:
+                path.unlink()
+
+    def is_stale(
+        self,
+        prefix: str,
+        year: int,
+        month: int,
+        ncm_ids: list,
+        metrics_columns: list,
+        now: datetime = None,
+    ) -> bool:
+        """
+        A partition must be (re)fetched when it is missing, was fetched for a
+        different set of NCM ids or metrics or is still revisable and was not
+        refreshed recently.
+        """
+        now = now or datetime.now()
+        entry = self.manifest["partitions"].get(self.partition_key(prefix, year, month))
+        if entry is None or entry["query_hash"] != hash_query(ncm_ids, metrics_columns):
+            return True
+
+        fetched_at = datetime.fromisoformat(entry["fetched_at"])
+        is_final = fetched_at >= add_months(
+            month_end(year, month), REVISION_WINDOW_MONTHS
+        )
+        return not is_final and now - fetched_at >= REVISABLE_REFRESH_INTERVAL
+
+    def stale_months(
+        self,
+        prefix: str,
+        year: int,
+        ncm_ids: list,
+        metrics_columns: list,
+        now: datetime = None,
+    ) -> list:
+        return [
+            month
+            for month in range(1, 13)
+            if self.is_stale(prefix, year, month, ncm_ids, metrics_columns, now=now)
+        ]
+
+    def write_partition(
+        self,
+        prefix: str,
+        year: int,
+        month: int,
+        df: pd.DataFrame,
+        ncm_ids: list,
+        metrics_columns: list,
+        fetched_at: datetime = None,
+        quality_report: DataQualityReport = None,
+    ):
+        """
+        Write the records of a single month. Empty months are only recorded
+        in the manifest, as is the data quality report of the month.
+        Call save_manifest() to persist the manifest.
+        """
+        path = self.partition_path(prefix, year, month)
+        if df.empty:
+            path.unlink(missing_ok=True)
+        else:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            df.to_parquet(path, index=False)
+
+        self.manifest["partitions"][self.partition_key(prefix, year, month)] = {
+            "prefix": prefix,
+            "year": year,
+            "month": month,
+            "rows": len(df),
+            "query_hash": hash_query(ncm_ids, metrics_columns),
+            "content_hash": hash_records(df),
+            "fetched_at": (fetched_at or datetime.now()).isoformat(),
+            "quality": (quality_report or DataQualityReport()).to_dict(),
+        }
+
+    def _entries(self, prefixes: list, start_year: int, end_year: int) -> list:
+        return [
+            entry
+            for entry in self.manifest["partitions"].values()
+            if entry["prefix"] in prefixes and start_year <= entry["year"] <= end_year
+        ]
+
+    @staticmethod
+    def month_key(year: int, month: int) -> str:
+        return f"{year}-{month:02d}"
+
+    def _read_entries(self, entries: list) -> pa.Table:
+        paths = [
+            str(self.partition_path(entry["prefix"], entry["year"], entry["month"]))
+            for entry in entries
+            if entry["rows"] > 0
+        ]
+        if not paths:
+            return pa.table({})
+
+        return pa_dataset.dataset(sorted(paths), format="parquet").to_table()
+
+    def read(self, prefixes: list, start_year: int, end_year: int) -> pa.Table:
+        """
+        Read every stored, non empty month of the given prefixes and years.
+        """
+        return self._read_entries(self._entries(prefixes, start_year, end_year))
+
+    def read_months(self, prefixes: list, months: list) -> pa.Table:
+        """
+        Read the given "YYYY-MM" months (see month_key) of the given prefixes.
+        """
+        months = set(months)
+        return self._read_entries(
+            [
+                entry
+                for entry in self.manifest["partitions"].values()
+                if entry["prefix"] in prefixes
+                and self.month_key(entry["year"], entry["month"]) in months
+            ]
+        )
+
+    def month_hashes(self, prefixes: list, start_year: int, end_year: int) -> dict:
+        """
+        {"YYYY-MM": hash} of the stored months, over the given prefixes: the
+        hash of a month changes whenever one of its partitions does.
+        """
+        content = defaultdict(dict)
+        for entry in self._entries(prefixes, start_year, end_year):
+            content[self.month_key(entry["year"], entry["month"])][entry["prefix"]] = (
+                entry["content_hash"]
+            )
+        return {
+            month: hashlib.sha1(
+                json.dumps(hashes, sort_keys=True).encode()
+            ).hexdigest()[:12]
+            for month, hashes in content.items()
+        }
+
+    def quality_report(
+        self, prefixes: list, start_year: int, end_year: int, ncm_ids: list = None
+    ) -> DataQualityReport:
+        """
+        Merged data quality reports of the stored months, without reading
+        them. With ncm_ids, only the issues of those products are kept: a
+        prefix partition also holds products a dataset does not select.
+        """
+        report = DataQualityReport()
+        for entry in self._entries(prefixes, start_year, end_year):
+            entry_report = DataQualityReport.from_dict(entry["quality"])
+            if ncm_ids is not None:
+                entry_report = entry_report.select(ncm_ids)
+            report = report.merge(entry_report)
+        return report
@@ -1,7 +1,20 @@
 # seasonal_decompose_plot.py
 
+import math
+import threading
+
+import pandas as pd
 import plotly.graph_objects as go
-import plotly.express as px
+
+from collections import OrderedDict
+
+# figures are built with at most about this many bars / points
+POINT_BUDGET = 1000
+# monthly data is aggregated to the first of these frequencies within budget
+FREQUENCY_MONTHS = {"MS": 1, "QS": 3, "YS": 12}
+FREQUENCY_LABELS = {"MS": "monthly", "QS": "quarterly", "YS": "yearly"}
+FIGURE_CACHE_SIZE = 128
+RAW_TABLE_PAGE_SIZE = 500  # rows sent to the browser at once
 
 
 def plot_trend_with_bar(
@@ -17,6 +30,8 @@ def plot_trend_with_bar(
     """
     Generate a bar plot with a trendline overlay using Plotly.
     """
+    import plotly.express as px  # slow import, only once a bar chart is built
+
     # Bar plot
     fig = px.bar(
         data,
@@ -51,6 +66,8 @@ def plot_bar_by_class(data, x_key, y_key, color_key, color_map, title):
     """
     Generate a bar chart showing the share by product class.
     """
+    import plotly.express as px
+
     fig = px.bar(
         data,
         x=x_key,
@@ -70,7 +87,9 @@ def plot_bar_by_class(data, x_key, y_key, color_key, color_map, title):
     return fig
 
 
-def plot_seasonal_decompose(seasonal_arr, residual_arr):
+def plot_seasonal_decompose(
+    seasonal_arr, residual_arr, y_title="Weight (kg)", y_range=(-2e7, 2e7)
+):
     """
     Generate a Plotly figure showing the seasonal decomposition components.
     """
@@ -101,8 +120,8 @@ def plot_seasonal_decompose(seasonal_arr, residual_arr):
     # Update layout
     fig_decompose.update_layout(
         xaxis_title="Time",
-        yaxis_title="Weight (kg)",
-        yaxis_range=[-2e7, 2e7],
+        yaxis_title=y_title,
+        yaxis_range=y_range,  # None autoscales
         legend=dict(title="Components"),
         template="plotly_white",
     )
@@ -141,3 +160,74 @@ def plot_choropleth(
     )
 
     return fig
+
+
+def choose_frequency(start, end, n_series=1, point_budget=POINT_BUDGET) -> str:
+    """
+    Finest of FREQUENCY_MONTHS showing n_series between start and end
+    (inclusive months) within the point budget.
+    """
+    start, end = pd.Timestamp(start), pd.Timestamp(end)
+    n_months = (end.year - start.year) * 12 + end.month - start.month + 1
+    for frequency, months in FREQUENCY_MONTHS.items():
+        if math.ceil(n_months / months) * n_series <= point_budget:
+            return frequency
+    return frequency  # coarsest
+
+
+def downsample(data, x_key, y_key, frequency, group_key=None):
+    """
+    Sum the y_key of long monthly data per period (and group) of the frequency.
+    """
+    if frequency == "MS":
+        return data
+    keys = [pd.Grouper(key=x_key, freq=frequency)]
+    if group_key is not None:
+        keys.append(group_key)
+    return data.groupby(keys, observed=True)[y_key].sum().reset_index()
+
+
+def downsample_series(series, frequency, how="sum"):
+    """
+    Aggregate a monthly series per period of the frequency. Sums are only
+    given for complete periods, as missing months would bias them.
+    """
+    if frequency == "MS":
+        return series
+    resampled = series.resample(frequency)
+    if how == "sum":
+        return resampled.sum(min_count=FREQUENCY_MONTHS[frequency])
+    return resampled.agg(how)
+
+
+def page_count(n_rows, page_size=RAW_TABLE_PAGE_SIZE) -> int:
+    return max(1, math.ceil(n_rows / page_size))
+
+
+class FigureCache:
+    """
+    Least recently used cache of built figures, shared by every session.
+    Keys must identify everything a figure shows, e.g.
+    (figure name, data version, start, end, metric). Cached figures must not
+    be modified.
+    """
+
+    def __init__(self, max_entries=FIGURE_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._figures = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_build(self, key, build, *args, **kwargs):
+        with self._lock:
+            if key in self._figures:
+                self._figures.move_to_end(key)
+                return self._figures[key]
+
+        figure = build(*args, **kwargs)
+
+        with self._lock:
+            self._figures[key] = figure
+            self._figures.move_to_end(key)
+            while len(self._figures) > self.max_entries:
+                self._figures.popitem(last=False)
+        return figure
@@ -0,0 +1,139 @@
+import importlib.util
+import threading
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as pa_dataset
+
+from abc import ABC, abstractmethod
+
+
+class QueryBackend(ABC):
+    """
+    Date range queries over the processed records, kept in a parquet file
+    sorted by date. Only the needed columns and row groups are read, the
+    records are never loaded as a whole.
+
+    Ranges are inclusive month starts, as the dashboard date slider.
+    """
+
+    name = None
+
+    def __init__(self, path, dt_key: str):
+        self.path = str(path)
+        self.dt_key = dt_key
+
+    @abstractmethod
+    def count(self, start, end) -> int:
+        pass
+
+    @abstractmethod
+    def rows(
+        self, start, end, columns: list = None, limit: int = None, offset: int = 0
+    ) -> pd.DataFrame:
+        """
+        Records between start and end, in file (date) order.
+        """
+
+
+class PandasBackend(QueryBackend):
+    """
+    Fallback without extra dependencies: pyarrow skips the row groups out of
+    the range and the unneeded columns.
+    """
+
+    name = "pandas"
+
+    def __init__(self, path, dt_key: str):
+        super().__init__(path, dt_key)
+        self._dataset = pa_dataset.dataset(self.path, format="parquet")
+
+    def _range(self, start, end) -> pa_dataset.Expression:
+        dt = pa_dataset.field(self.dt_key)
+        return (dt >= pd.Timestamp(start)) & (dt <= pd.Timestamp(end))
+
+    def count(self, start, end) -> int:
+        table = self._dataset.to_table(
+            columns=[self.dt_key], filter=self._range(start, end)
+        )
+        return table.num_rows
+
+    def rows(self, start, end, columns=None, limit=None, offset=0) -> pd.DataFrame:
+        """
+        Scans the record batches in order, dropping the ones before offset,
+        and stops as soon as the page is read.
+        """
+        scanner = self._dataset.scanner(columns=columns, filter=self._range(start, end))
+        stop = None if limit is None else offset + limit
+        batches = []
+        skipped = read = 0
+        for batch in scanner.to_batches():
+            read += batch.num_rows
+            if read <= offset:
+                skipped += batch.num_rows
+                continue
+            batches.append(batch)
+            if stop is not None and read >= stop:
+                break
+        table = pa.Table.from_batches(batches, schema=scanner.projected_schema)
+        return table.slice(offset - skipped, limit).to_pandas()
+
+
+class DuckDBBackend(QueryBackend):
+    """
+    Embedded DuckDB: filters and projections are pushed down to its parquet
+    scan and run out of core.
+    """
+
+    name = "duckdb"
+
+    def __init__(self, path, dt_key: str):
+        import duckdb  # optional dependency
+
+        super().__init__(path, dt_key)
+        self._connection = duckdb.connect()
+        escaped_path = self.path.replace("'", "''")
+        self._connection.execute(
+            f"CREATE VIEW records AS SELECT * FROM read_parquet('{escaped_path}')"
+        )
+        self._lock = threading.Lock()
+
+    def _query(self, sql: str, parameters: list) -> pd.DataFrame:
+        with self._lock:
+            cursor = self._connection.cursor()  # one per query, across threads
+        try:
+            return cursor.execute(sql, parameters).df()
+        finally:
+            cursor.close()
+
+    def _range(self, start, end) -> tuple:
+        return (
+            f'"{self.dt_key}" BETWEEN ? AND ?',
+            [pd.Timestamp(start).to_pydatetime(), pd.Timestamp(end).to_pydatetime()],
+        )
+
+    def count(self, start, end) -> int:
+        where, parameters = self._range(start, end)
+        sql = f"SELECT count(*) AS n FROM records WHERE {where}"
+        return int(self._query(sql, parameters)["n"].iloc[0])
+
+    def rows(self, start, end, columns=None, limit=None, offset=0) -> pd.DataFrame:
+        where, parameters = self._range(start, end)
+        selected = ", ".join(f'"{column}"' for column in columns) if columns else "*"
+        sql = f"SELECT {selected} FROM records WHERE {where}"
+        if limit is not None:
+            sql += f" LIMIT {int(limit)} OFFSET {int(offset)}"
+        return self._query(sql, parameters)
+
+
+QUERY_BACKENDS = {"duckdb": DuckDBBackend, "pandas": PandasBackend}
+
+
+def create_query_backend(path, dt_key: str, engine: str = None) -> QueryBackend:
+    """
+    Query backend over a parquet file of records. DuckDB when installed,
+    else pandas, unless an engine is given.
+    """
+    if engine is None:
+        engine = "duckdb" if importlib.util.find_spec("duckdb") else "pandas"
+    return QUERY_BACKENDS[engine](path, dt_key=dt_key)
@@ -0,0 +1,91 @@
+"""
+Refresh the dashboard data out of band.
+
+Syncs the partitioned store with COMEXSTAT, builds the processed dataset and
+every derived aggregate into a new versioned snapshot, then atomically points
+the dashboard to it. Run it once, or on a schedule, for one or more datasets
+(fetch_data.DATASET_SPECS) sharing the already fetched partitions:
+
+    python refresh_worker.py --once
+    python refresh_worker.py --interval-hours 6 --datasets pesticides fertilizers
+"""
+
+import argparse
+import time
+import traceback
+
+import fetch_data as fd
+import instrumentation
+from partition_store import PartitionedStore
+from snapshot_store import SnapshotStore
+
+DEFAULT_INTERVAL_HOURS = 6
+
+
+def refresh(
+    store: PartitionedStore,
+    snapshot_store: SnapshotStore,
+    force: bool = False,
+    spec: fd.DatasetSpec = fd.PESTICIDES_DATASET,
+) -> str:
+    """
+    Build and publish a snapshot of the current data of a spec, returning the
+    name it is published as. The version is known once the store is synced:
+    a version already written is only published again, without processing,
+    unless forced.
+    """
+    version = fd.dataset_version(store, spec, fd.sync_dataset_store(store, spec))
+    if not force and snapshot_store.exists(version):
+        name = snapshot_store.latest(version)
+        snapshot_store.publish(name)
+        print(f"{spec.name} snapshot {name} is up to date")
+    else:
+        snapshot = fd.build_snapshot(store, spec=spec)  # the sync is a no-op now
+        name = fd.save_snapshot(snapshot, snapshot_store)
+        print(f"Published {spec.name} snapshot {name} ({len(snapshot.data)} rows)")
+    snapshot_store.prune()
+    return name
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--once", action="store_true", help="refresh once and exit")
+    parser.add_argument("--interval-hours", type=float, default=DEFAULT_INTERVAL_HOURS)
+    parser.add_argument(
+        "--force", action="store_true", help="rewrite an existing snapshot"
+    )
+    parser.add_argument(
+        "--datasets",
+        nargs="+",
+        choices=list(fd.DATASET_SPECS),
+        default=[fd.PESTICIDES_DATASET.name],
+    )
+    parser.add_argument("--store-dir", help="partitioned stores directory")
+    parser.add_argument("--snapshot-dir", help="snapshots directory")
+    args = parser.parse_args()
+
+    instrumentation.configure_logging()  # stage timings as json lines
+    specs = [fd.DATASET_SPECS[name] for name in args.datasets]
+    store_root = args.store_dir or fd.DEFAULT_STORE_DIR
+    snapshot_root = args.snapshot_dir or fd.DEFAULT_SNAPSHOT_DIR
+
+    while True:
+        for spec in specs:
+            try:
+                refresh(
+                    fd.dataset_store(spec, root=store_root),
+                    fd.dataset_snapshot_store(spec, root=snapshot_root),
+                    force=args.force,
+                    spec=spec,
+                )
+            except Exception:
+                if args.once:
+                    raise
+                traceback.print_exc()  # keep serving the previous snapshot
+        if args.once:
+            break
+        time.sleep(args.interval_hours * 3600)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+import numpy as np
+import pandas as pd
+
+# pseudo dimension of the one hot product classes. A record counts once for
+# every class it belongs to, as in fetch_data.melt_and_group_by_classes_and_dt
+CLASS_DIMENSION = "class"
+
+
+class RollupCube:
+    """
+    Month x class x country x state x transport pre-aggregation of the records.
+
+    Besides the (sparse) cube itself, every dimension keeps a dense
+    month x value matrix of cumulative sums, so the sum of any date range is
+    two row lookups per cell, whatever the number of records.
+    """
+
+    def __init__(
+        self,
+        cube: pd.DataFrame,
+        months: pd.DatetimeIndex,
+        cumulative_sums: dict,
+        dt_key: str,
+        value_keys: list,
+    ):
+        self.cube = cube
+        self.months = months
+        self.cumulative_sums = cumulative_sums
+        self.dt_key = dt_key
+        self.value_keys = value_keys
+
+    @classmethod
+    def from_frame(
+        cls,
+        df: pd.DataFrame,
+        dt_key: str,
+        class_keys: list,
+        dimensions: list,
+        value_keys: list,
+    ) -> "RollupCube":
+        if df.empty:  # no records: no months, no dimension values
+            dimensions = []
+            df = pd.DataFrame(
+                {dt_key: pd.to_datetime([])}
+                | {class_key: pd.Series(dtype=bool) for class_key in class_keys}
+                | {value_key: pd.Series(dtype=float) for value_key in value_keys}
+            )
+        cube = (
+            df.groupby([dt_key] + class_keys + dimensions, observed=True, dropna=False)[
+                value_keys
+            ]
+            .sum()
+            .reset_index()
+        )
+        months = (
+            pd.date_range(cube[dt_key].min(), cube[dt_key].max(), freq="MS")
+            if len(cube)
+            else pd.DatetimeIndex([])
+        )
+
+        monthly_sums = {
+            dimension: cube.pivot_table(
+                index=dt_key,
+                columns=dimension,
+                values=value_keys,
+                aggfunc="sum",
+                observed=True,
+            )
+            for dimension in dimensions
+        }
+        monthly_sums[CLASS_DIMENSION] = pd.concat(
+            {
+                value_key: pd.DataFrame(
+                    {
+                        class_key: cube.loc[cube[class_key], [dt_key, value_key]]
+                        .groupby(dt_key)[value_key]
+                        .sum()
+                        for class_key in class_keys
+                    }
+                )
+                for value_key in value_keys
+            },
+            axis=1,
+        )
+
+        cumulative_sums = {
+            dimension: cls._cumulate(monthly, months)
+            for dimension, monthly in monthly_sums.items()
+        }
+        return cls(cube, months, cumulative_sums, dt_key, value_keys)
+
+    @staticmethod
+    def _cumulate(monthly: pd.DataFrame, months: pd.DatetimeIndex) -> pd.DataFrame:
+        """
+        Cumulative sums with a leading zero row: the sum of months [i, j) is
+        row j minus row i.
+        """
+        dense = monthly.reindex(months, fill_value=0).fillna(0).to_numpy(dtype=float)
+        cumulative = np.vstack([np.zeros((1, dense.shape[1])), dense.cumsum(axis=0)])
+        return pd.DataFrame(cumulative, columns=monthly.columns)
+
+    def _positions(self, start, end) -> tuple:
+        start_pos = self.months.searchsorted(pd.Timestamp(start), side="left")
+        end_pos = self.months.searchsorted(pd.Timestamp(end), side="right")
+        return start_pos, max(start_pos, end_pos)
+
+    def range_sum(self, dimension: str, start, end, value_key: str) -> pd.Series:
+        """
+        Sum of value_key per value of the dimension between start and end
+        (inclusive).
+        """
+        start_pos, end_pos = self._positions(start, end)
+        cumulative = self.cumulative_sums[dimension][value_key]
+        return cumulative.iloc[end_pos] - cumulative.iloc[start_pos]
+
+    def monthly(self, dimension: str, start, end, value_key: str) -> pd.DataFrame:
+        """
+        Long (dt, dimension, value_key) monthly sums between start and end,
+        without empty cells.
+        """
+        start_pos, end_pos = self._positions(start, end)
+        monthly = self.monthly_matrix(dimension, value_key).iloc[start_pos:end_pos]
+        long = monthly.stack().rename(value_key).reset_index()
+        return long[long[value_key] != 0]
+
+    def monthly_matrix(self, dimension: str, value_key: str) -> pd.DataFrame:
+        """
+        Dense month x dimension value sums over every month of the cube.
+        """
+        cumulative = self.cumulative_sums[dimension][value_key]
+        return pd.DataFrame(
+            np.diff(cumulative.to_numpy(), axis=0),
+            index=pd.Index(self.months, name=self.dt_key),
+            columns=pd.Index(cumulative.columns, name=dimension),
+        )
+
+    def monthly_total(self, value_key: str) -> pd.Series:
+        """
+        Dense monthly sums of every record, each counted once.
+        """
+        return (
+            self.cube.groupby(self.dt_key)[value_key]
+            .sum()
+            .reindex(self.months, fill_value=0)
+            .rename_axis(self.dt_key)
+        )
@@ -0,0 +1,146 @@
+import json
+import os
+import shutil
+
+import pandas as pd
+
+from datetime import datetime
+from pathlib import Path
+
+DEFAULT_SNAPSHOT_DIR = Path(__file__).resolve().parents[1] / "data" / "snapshots"
+CURRENT_FILE_NAME = "CURRENT"
+METADATA_FILE_NAME = "snapshot.json"
+# snapshots kept besides the current one, for sessions still reading them
+KEEP_PREVIOUS_SNAPSHOTS = 2
+# frames are sorted by date: small row groups let readers skip whole date
+# ranges using the parquet statistics
+ROW_GROUP_SIZE = 50_000
+
+
+class SnapshotStore:
+    """
+    Versioned snapshots of the processed dataset and of its derived
+    aggregates, with a "current" pointer swapped atomically once a snapshot is
+    completely written.
+
+    Layout: <root>/<version>/<name>.parquet, <root>/<version>/snapshot.json
+    and <root>/CURRENT
+
+    A written snapshot directory never changes, readers may still be using
+    it: a version written again (forced) goes to "<version>.<n>". That
+    directory name is what publish, current_version and the readers take.
+    """
+
+    def __init__(self, root=DEFAULT_SNAPSHOT_DIR):
+        self.root = Path(root)
+        self.current_path = self.root / CURRENT_FILE_NAME
+
+    def snapshot_dir(self, version: str) -> Path:
+        return self.root / version
+
+    def revisions(self, version: str) -> list:
+        """
+        Names of the written snapshots of a version, oldest first.
+        """
+        names = [
+            path.name
+            for path in self.root.glob(f"{version}*")
+            if path.name.partition(".")[0] == version
+            and (path / METADATA_FILE_NAME).exists()
+        ]
+        return sorted(names, key=_revision_number)
+
+    def exists(self, version: str) -> bool:
+        return bool(self.revisions(version))
+
+    def latest(self, version: str) -> str:
+        """
+        Name of the last written snapshot of a version.
+        """
+        return self.revisions(version)[-1]
+
+    def current_version(self):
+        """
+        Version the current pointer refers to, None before the first publish.
+        """
+        if not self.current_path.exists():
+            return None
+        return self.current_path.read_text().strip() or None
+
+    def write(self, version: str, frames: dict, metadata: dict = None) -> str:
+        """
+        Write the {name: frame} of a snapshot, returning the name of its
+        directory. The snapshot is written to a temporary directory first,
+        then renamed, so a snapshot directory is always complete.
+        """
+        revisions = self.revisions(version)
+        name = (
+            f"{version}.{_revision_number(revisions[-1]) + 1}" if revisions else version
+        )
+        tmp_dir = self.root / f".{name}.tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        tmp_dir.mkdir(parents=True)
+
+        for frame_name, frame in frames.items():
+            frame.to_parquet(
+                tmp_dir / f"{frame_name}.parquet", row_group_size=ROW_GROUP_SIZE
+            )
+        with open(tmp_dir / METADATA_FILE_NAME, "w") as f:
+            json.dump(
+                {
+                    "version": version,
+                    "name": name,
+                    "created_at": datetime.now().isoformat(),
+                    "frames": list(frames),
+                    **(metadata or {}),
+                },
+                f,
+                indent=1,
+            )
+
+        os.replace(tmp_dir, self.snapshot_dir(name))  # a new name: atomic
+        return name
+
+    def publish(self, version: str):
+        """
+        Point "current" to a written snapshot (a name returned by write).
+        """
+        if not (self.snapshot_dir(version) / METADATA_FILE_NAME).exists():
+            raise FileNotFoundError(f"Snapshot {version} was not written")
+        tmp_path = self.current_path.with_suffix(".tmp")
+        tmp_path.write_text(version)
+        os.replace(tmp_path, self.current_path)  # atomic
+
+    def frame_path(self, version: str, name: str) -> Path:
+        return self.snapshot_dir(version) / f"{name}.parquet"
+
+    def read_frame(self, version: str, name: str) -> pd.DataFrame:
+        return pd.read_parquet(self.frame_path(version, name))
+
+    def read_metadata(self, version: str) -> dict:
+        with open(self.snapshot_dir(version) / METADATA_FILE_NAME) as f:
+            return json.load(f)
+
+    def prune(self, keep: int = KEEP_PREVIOUS_SNAPSHOTS):
+        """
+        Remove all but the current and the `keep` latest other snapshots.
+        """
+        current_version = self.current_version()
+        previous = sorted(
+            (
+                path
+                for path in self.root.iterdir()
+                if path.is_dir()
+                and not path.name.startswith(".")
+                and path.name != current_version
+            ),
+            key=lambda path: path.stat().st_mtime,
+            reverse=True,
+        )
+        for path in previous[keep:]:
+            shutil.rmtree(path)
+
+
+def _revision_number(name: str) -> int:
+    # "<version>" is the first write, "<version>.<n>" the n-th rewrite
+    return int(name.partition(".")[2] or 0)
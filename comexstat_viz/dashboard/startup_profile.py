@@ -0,0 +1,142 @@
+"""
+Startup profile of the dashboard process.
+
+Reports the import cost of the dashboard modules per package (from
+`python -X importtime`) and measures a cold start: a fresh process running
+app.py once against the current snapshot. Exits 1 when over budget, or when
+a dependency only some code paths need was loaded.
+
+    python refresh_worker.py --once  # publish the snapshot the app reads
+    python startup_profile.py
+    python startup_profile.py --import-budget 1 --cold-start-budget 8
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+
+from collections import defaultdict
+from pathlib import Path
+
+import fetch_data as fd
+
+DASHBOARD_DIR = Path(__file__).resolve().parent
+APP_MODULES = ["fetch_data", "plots", "decomposition"]
+# only imported by the code paths needing them, never on a snapshot start
+LAZY_MODULES = ["statsmodels", "requests", "ijson", "comexstat_client"]
+
+IMPORT_BUDGET_SECONDS = 1.0
+COLD_START_BUDGET_SECONDS = 8.0
+REPORTED_PACKAGES = 15
+
+COLD_START_SCRIPT = """
+import json, sys, time
+
+start = time.perf_counter()
+from streamlit.testing.v1 import AppTest
+
+imported = time.perf_counter()
+app = AppTest.from_file("app.py", default_timeout=600)
+app.run()
+print(json.dumps({
+    "streamlit_import": imported - start,
+    "first_run": time.perf_counter() - imported,
+    "exceptions": [str(exception.value) for exception in app.exception],
+    "lazy_loaded": sorted(set(sys.modules) & set(%(lazy_modules)r)),
+}))
+"""
+
+
+def import_times(modules: list) -> dict:
+    """
+    Seconds spent importing every top level package (self time, summed),
+    in a fresh interpreter.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {', '.join(modules)}"],
+        cwd=DASHBOARD_DIR,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    seconds = defaultdict(float)
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, _, name = line.removeprefix("import time:").split("|")
+        seconds[name.strip().split(".")[0]] += int(self_us) / 1e6
+    return dict(seconds)
+
+
+def cold_start() -> dict:
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            COLD_START_SCRIPT % {"lazy_modules": LAZY_MODULES},
+        ],
+        cwd=DASHBOARD_DIR,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--import-budget", type=float, default=IMPORT_BUDGET_SECONDS)
+    parser.add_argument(
+        "--cold-start-budget", type=float, default=COLD_START_BUDGET_SECONDS
+    )
+    parser.add_argument(
+        "--imports-only", action="store_true", help="skip the cold start"
+    )
+    args = parser.parse_args()
+
+    failures = []
+
+    seconds = import_times(APP_MODULES)
+    total = sum(seconds.values())
+    print(f"{'package':<24} {'seconds':>8}")
+    for package, package_seconds in sorted(
+        seconds.items(), key=lambda item: item[1], reverse=True
+    )[:REPORTED_PACKAGES]:
+        print(f"{package:<24} {package_seconds:>8.3f}")
+    print(f"{'total':<24} {total:>8.3f}")
+    if total > args.import_budget:
+        failures.append(f"imports took {total:.2f}s > {args.import_budget}s")
+    for module in set(seconds) & set(LAZY_MODULES):
+        failures.append(f"{module} is imported eagerly")
+
+    if not args.imports_only:
+        if fd.dataset_snapshot_store(fd.PESTICIDES_DATASET).current_version() is None:
+            raise SystemExit(
+                "No published snapshot, run refresh_worker.py --once first"
+            )
+        measured = cold_start()
+        cold_start_seconds = measured["streamlit_import"] + measured["first_run"]
+        print(
+            f"cold start: {cold_start_seconds:.2f}s "
+            f"(streamlit {measured['streamlit_import']:.2f}s, "
+            f"first run {measured['first_run']:.2f}s)"
+        )
+        if measured["exceptions"]:
+            failures.append(f"app raised {measured['exceptions']}")
+        if cold_start_seconds > args.cold_start_budget:
+            failures.append(
+                f"cold start took {cold_start_seconds:.2f}s "
+                f"> {args.cold_start_budget}s"
+            )
+        for module in measured["lazy_loaded"]:
+            failures.append(f"{module} was loaded reading the snapshot")
+
+    for failure in failures:
+        print(f"OVER BUDGET {failure}")
+    if failures:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()